@@ -0,0 +1,93 @@
+"""Per-call cost of building the maps from scratch vs patching a template
+
+Also checks that both give byte-identical json. Run from the covid-data
+directory (a ".mapbox_token" file is needed, any contents will do) with:
+
+    python -m benchmarks.map_templates --repeat 50
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+from module import maps
+from module.data_handling import DataHandler
+from module.geo_assets import GeoAssets
+from module.fresh_data import FreshData
+
+
+def _to_json(fig):
+    if isinstance(fig, dict):
+        return json.dumps(fig, cls=PlotlyJSONEncoder)
+    return json.dumps(fig.to_plotly_json(), cls=PlotlyJSONEncoder)
+
+
+def _fake_map_dfs(states_meta_df, states_geo, rng):
+    """Map dfs with random rates, shaped like the ones `FreshData` loads"""
+    states_map_df = states_meta_df[['abbr']].copy()
+    states_map_df['ave_rate'] = rng.uniform(0, 60, len(states_map_df))
+    states_map_df['text'] = ['<b>{}</b>'.format(s) for s in states_map_df.index]
+
+    fips_state = {f: s for s, f in states_meta_df['fips'].dropna().items()}
+    rows = [dict(fips=f['id'], state=fips_state[f['properties']['STATE']])
+            for f in states_geo['USA']['features']
+            if f['properties']['STATE'] in fips_state]
+    counties_map_df = pd.DataFrame(rows)
+    counties_map_df['ave_rate'] = rng.uniform(0, 60, len(counties_map_df))
+    counties_map_df['text'] = counties_map_df['fips']
+    return states_map_df, counties_map_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--state', default='California')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    states_meta_df = DataHandler.load_states_csv()
+    states_geo = FreshData._index_geo_by_state(states_meta_df)
+    geo_assets = GeoAssets(states_geo)
+    date = datetime(2021, 3, 1)
+
+    for name, state in [('states_map', None), ('counties_map USA', 'USA'),
+                        ('counties_map ' + args.state, args.state)]:
+        states_map_df, counties_map_df = _fake_map_dfs(
+            states_meta_df, states_geo, rng)
+        if state is None:
+            old = lambda: maps._build_states_map(states_map_df, date)
+            new = lambda: maps.states_map(states_map_df, date)
+        else:
+            df = counties_map_df
+            if state != 'USA':
+                df = df[df['state'] == state]
+            url = geo_assets.url(state)
+            old = lambda: maps._build_counties_map(df, url, states_meta_df, state)
+            new = lambda: maps.counties_map(df, url, states_meta_df, state)
+
+        # Build the template with different data first, so this also checks
+        # that patching a template gives the same output
+        other_states_df, other_counties_df = _fake_map_dfs(
+            states_meta_df, states_geo, rng)
+        if state is None:
+            maps.states_map(other_states_df, datetime(2021, 1, 1))
+        else:
+            if state != 'USA':
+                other_counties_df = other_counties_df[
+                    other_counties_df['state'] == state]
+            maps.counties_map(other_counties_df, geo_assets.url(state),
+                              states_meta_df, state)
+
+        identical = _to_json(old()) == _to_json(new())
+        old_ms = min(timeit.repeat(old, number=1, repeat=args.repeat)) * 1000
+        new_ms = min(timeit.repeat(new, number=1, repeat=args.repeat)) * 1000
+        print('{:>28}: build {:8.2f} ms, template {:8.2f} ms, '
+              'identical json: {}'.format(name, old_ms, new_ms, identical))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Compare memory used by the old counties data and by `CasesStore`
+
+Before: a float64 `counties_df` plus the `fips_pop_dict` and
+`fips_county_dict` dicts that `FreshData` used to build.
+After: a `CasesStore`.
+
+Run from the covid-data directory with:
+
+    python -m benchmarks.memory_report --days 700 --locations 3300
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from module.cases_store import CasesStore
+
+
+def dict_nbytes(d):
+    """Bytes used by a dict, including its keys and values"""
+    return sys.getsizeof(d) + sum(
+        sys.getsizeof(k) + sys.getsizeof(v) for k, v in d.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=700)
+    parser.add_argument('--locations', type=int, default=3300)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    fips = ['{:05d}'.format(i) for i in range(args.locations)]
+    cases_df = pd.DataFrame(
+        rng.poisson(20, size=(args.days, args.locations)).astype(float),
+        index=pd.date_range('2020-02-24', periods=args.days),
+        columns=pd.Index(fips, name='fips'))
+    pop_s = pd.Series(rng.integers(1000, 10 ** 7, args.locations), index=fips)
+    name_s = pd.Series(['County {}, State'.format(f) for f in fips], index=fips)
+
+    before = dict(
+        cases=int(cases_df.memory_usage(index=False).sum()),
+        dates=cases_df.index.memory_usage(deep=True),
+        locations=cases_df.columns.memory_usage(deep=True),
+        pops=dict_nbytes(pop_s.to_dict()),
+        names=dict_nbytes(name_s.to_dict()),
+    )
+    after = CasesStore(cases_df.astype(np.int32), pop_s, name_s).nbytes()
+
+    print('{:>10} {:>12} {:>12}'.format('component', 'before', 'after'))
+    for k in before:
+        print('{:>10} {:>12,} {:>12,}'.format(k, before[k], after[k]))
+    print('{:>10} {:>12,} {:>12,}'.format(
+        'total', sum(before.values()), sum(after.values())))
+
+
+if __name__ == '__main__':
+    main()
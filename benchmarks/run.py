@@ -0,0 +1,215 @@
+"""Offline benchmarks for the ETL and the dashboard callbacks
+
+Generates John Hopkins shaped csv files (see `benchmarks.synthetic`), runs
+`get_and_save_data` on them, and then times `FreshData()` and the functions
+the callbacks use. Nothing needs network access. Each stage is run
+`--repeat` times, and the min and median wall time plus the peak memory
+allocated (from tracemalloc) are recorded.
+
+`--storage` picks the backend the data is saved to and loaded from (see
+module/storage.py), all of them local stand-ins: 'bucket' is the google
+cloud storage code path on a `LocalBucket`, 'http' is `HTTPStorage` talking
+to the object store server from `start_server`, and 'memory' is
+`MemoryStorage`. With `--latency` every request waits that many seconds, to
+see how much of the time is spent on I/O.
+
+Run from the covid-data directory with:
+
+    python -m benchmarks.run --locations 3300 --days 700 --out results.json
+    python -m benchmarks.run --storage http --latency 0.05
+    python -m benchmarks.run --compare old.json new.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic import write_jhu_csvs
+from constants import GEO_LEVELS
+from module import data_handling
+from module.local_bucket import LocalBucket
+from module.storage import (GCSStorage, HTTPStorage, LocalStorage,
+                            MemoryStorage, start_server)
+from module.fresh_data import FreshData
+from module.geo_simplify import geo_file
+from module.graphs_and_tables import trend_table, CasesGraph
+from module.maps import states_map, counties_map
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(func, repeat):
+    """Run `func` `repeat` times and return timing and memory stats
+
+    Returns:
+        dict: 'min_secs', 'median_secs' and 'peak_mb'
+
+    """
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return dict(min_secs=min(times), median_secs=statistics.median(times),
+                peak_mb=peak / 2 ** 20)
+
+
+def _storage(name, directory, latency):
+    """A storage backend for `--storage`, and a function that shuts it down"""
+    if name == 'bucket':
+        return GCSStorage(bucket=LocalBucket(directory, latency)), lambda: None
+    if name == 'http':
+        server, url = start_server(LocalStorage(directory), latency=latency)
+        return HTTPStorage(url), server.shutdown
+    if name == 'memory':
+        return MemoryStorage(latency), lambda: None
+    return LocalStorage(), lambda: None
+
+
+def run(n_locations, n_days, repeat, state, storage='local', latency=0):
+    """Run all of the benchmarks in a temp directory
+
+    Returns:
+        dict: Stage name to the stats from `measure`
+
+    """
+    repo_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Everything reads and writes relative to the working directory
+        os.chdir(tmp)
+        backend, shutdown = _storage(storage, os.path.join(tmp, 'store'),
+                                     latency)
+        try:
+            os.mkdir('data')
+            geo_files = [geo_file(level) for level in ['full', *GEO_LEVELS]]
+            for f in ['data/states.csv', *geo_files]:
+                os.symlink(os.path.join(repo_dir, f), f)
+            with open('.mapbox_token', 'w') as f:
+                f.write('benchmark')
+            data_handling.DataHandler.use_storage(backend)
+            return _run_stages(n_locations, n_days, repeat, state)
+        finally:
+            data_handling.DataHandler.use_storage(None)
+            shutdown()
+            os.chdir(repo_dir)
+
+
+def _run_stages(n_locations, n_days, repeat, state):
+    cases_path = os.path.abspath('cases.csv')
+    deaths_path = os.path.abspath('deaths.csv')
+    data_handling.CASES_FILE = 'file://' + cases_path
+    data_handling.DEATHS_FILE = 'file://' + deaths_path
+
+    results = {}
+    results['generate_csvs'] = measure(
+        lambda: write_jhu_csvs(cases_path, deaths_path, n_locations, n_days),
+        1)
+    results['get_and_save_data_full'] = measure(
+        lambda: data_handling.get_and_save_data(full_rebuild=True), repeat)
+
+    # One more day of data, processed incrementally
+    write_jhu_csvs(cases_path, deaths_path, n_locations, n_days + 1)
+    results['get_and_save_data_incremental'] = measure(
+        data_handling.get_and_save_data, 1)
+
+    results['fresh_data_init'] = measure(FreshData, repeat)
+    fd = FreshData()
+    snap = fd.snapshot
+    fips = snap.counties.locations[len(snap.counties.locations) // 2]
+
+    results['states_map'] = measure(
+        lambda: states_map(snap.states_map_df, snap.states_df.index[-1]),
+        repeat)
+    results['states_map_df_as_of'] = measure(
+        lambda: snap.states_map_df_as_of(90, 14), repeat)
+    results['state_counties_as_of_USA'] = measure(
+        lambda: snap.state_counties_rows('USA', 90, 14), repeat)
+    for s in ['USA', state]:
+        def build(s=s):
+            # As the app does it, the browser fetches the geojson separately
+            df = snap.state_counties_rows(s)
+            return counties_map(df, fd.geo_assets.url(s), fd.states_meta_df, s)
+        results['counties_map_{}'.format(s)] = measure(build, repeat)
+    results['trend_table'] = measure(
+        lambda: trend_table(snap.trends_df.loc[state]), repeat)
+    results['state_or_county_graph_state'] = measure(
+        lambda: CasesGraph.state_or_county_graph(
+            snap.states.series(state), snap.states.pop(state)), repeat)
+    results['state_or_county_graph_county'] = measure(
+        lambda: CasesGraph.state_or_county_graph(
+            snap.counties.series(fips), snap.counties.pop(fips)), repeat)
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('{} ({}) -> {} ({})'.format(old_path, old['commit'],
+                                      new_path, new['commit']))
+    print('{:>32} {:>10} {:>10} {:>8} {:>10} {:>10}'.format(
+        'stage', 'old secs', 'new secs', 'ratio', 'old MB', 'new MB'))
+    for stage, n in new['results'].items():
+        o = old['results'].get(stage)
+        if o is None:
+            continue
+        print('{:>32} {:>10.4f} {:>10.4f} {:>8.2f} {:>10.1f} {:>10.1f}'.format(
+            stage, o['min_secs'], n['min_secs'],
+            n['min_secs'] / o['min_secs'] if o['min_secs'] else float('nan'),
+            o['peak_mb'], n['peak_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--locations', type=int, default=3300)
+    parser.add_argument('--days', type=int, default=700,
+                        help='Days of history, e.g. 730-1825 for 2-5 years')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--state', default='California')
+    parser.add_argument('--storage', default='local',
+                        choices=['local', 'bucket', 'http', 'memory'],
+                        help='Storage backend to save and load the data with')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds every storage request waits, not used '
+                             'with local storage')
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run(args.locations, args.days, args.repeat, args.state,
+                  args.storage, args.latency)
+    output = dict(commit=_git_commit(),
+                  config=dict(locations=args.locations, days=args.days,
+                              repeat=args.repeat, state=args.state,
+                              storage=args.storage, latency=args.latency),
+                  results=results)
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    for stage, r in results.items():
+        print('{:>32}: {:8.4f}s min, {:8.4f}s median, {:8.1f} MB peak'.format(
+            stage, r['min_secs'], r['median_secs'], r['peak_mb']))
+
+
+if __name__ == '__main__':
+    main()
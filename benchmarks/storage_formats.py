@@ -0,0 +1,117 @@
+"""Compare load time and memory of the pickle and .npy formats for counties_df
+
+Run from the covid-data directory with:
+
+    python -m benchmarks.storage_formats --days 700 --locations 3300
+
+Each load is done in a fresh subprocess so RSS numbers aren't affected by
+earlier loads.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from module.data_handling import DataHandler
+
+
+def rss_mb():
+    """Current resident set size of this process in MB"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def make_cases_df(days, locations):
+    """Synthetic new cases df shaped like `counties_df`"""
+    rng = np.random.default_rng(0)
+    index = pd.date_range('2020-02-24', periods=days)
+    columns = pd.Index(['{:05d}'.format(i) for i in range(locations)],
+                       name='fips')
+    values = rng.poisson(20, size=(days, locations)).astype(float)
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+PKL_FILE = 'data/counties_df.pkl'
+NPY_FILES = ('data/counties_df.npy', 'data/counties_df.index.json')
+
+
+def read_file(fmt, columns=None):
+    """Read 'counties_df' the way `Bundle.load_cases` would in a format"""
+    if fmt == 'pkl':
+        df = pd.read_pickle(PKL_FILE)
+        return df if columns is None else df[columns]
+    return DataHandler._read_local_npy(*NPY_FILES, columns)
+
+
+def load(fmt, column):
+    """Load 'counties_df' in a format and print timing and memory as json"""
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    df = read_file(fmt)
+    load_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ser_sum = float(df[column].sum())
+    column_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    one_col = read_file(fmt, [column])
+    assert float(one_col[column].sum()) == ser_sum
+    one_column_load_secs = time.perf_counter() - start
+
+    print(json.dumps(dict(format=fmt,
+                          load_secs=load_secs,
+                          read_column_secs=column_secs,
+                          one_column_load_secs=one_column_load_secs,
+                          rss_added_mb=rss_mb() - rss_before)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=700)
+    parser.add_argument('--locations', type=int, default=3300)
+    parser.add_argument('--load', help=argparse.SUPPRESS)
+    parser.add_argument('--column', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        load(args.load, args.column)
+        return
+
+    repo_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.mkdir('data')
+        df = make_cases_df(args.days, args.locations)
+        pd.to_pickle(df, PKL_FILE)
+        DataHandler._write_npy(df, *NPY_FILES)
+        del df
+
+        env = dict(os.environ, PYTHONPATH=repo_dir)
+        results = []
+        for fmt in ['pkl', 'npy']:
+            out = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.storage_formats',
+                 '--load', fmt, '--column', '{:05d}'.format(args.locations // 2)],
+                env=env, check=True, stdout=subprocess.PIPE,
+                universal_newlines=True).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+        os.chdir(repo_dir)
+
+    for r in results:
+        print('{format}: load {load_secs:.4f}s, one column from loaded df '
+              '{read_column_secs:.4f}s, load one column '
+              '{one_column_load_secs:.4f}s, RSS +{rss_added_mb:.1f} MB'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Write csv files in the exact schema of the John Hopkins US time series
+
+The counties are taken from "data/geojson-counties-fips.json" so the maps
+work with the generated data. If more locations are asked for than there are
+counties in the geojson, extra made-up counties are added to each state.
+"""
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# These are dropped by name in `get_and_save_data`, so they have to exist
+TERRITORIES = ['Diamond Princess', 'Guam', 'American Samoa', 'Grand Princess',
+               'Northern Mariana Islands', 'Virgin Islands']
+
+FIRST_DATE = datetime(2020, 1, 22)
+
+
+def _locations(n_locations, states_csv, geo_json):
+    states_df = pd.read_csv(states_csv, index_col=0, dtype=dict(fips=str))
+    states_df = states_df.drop('USA')
+    fips_state = {f: s for s, f in states_df['fips'].items()}
+
+    with open(geo_json) as f:
+        features = json.load(f)['features']
+    rows = [dict(fips=f['id'], county=f['properties']['NAME'],
+                 state=fips_state[f['properties']['STATE']])
+            for f in features if f['properties']['STATE'] in fips_state]
+
+    extra_i = 0
+    while len(rows) < n_locations:
+        state = states_df.index[extra_i % len(states_df)]
+        county_num = 900 + extra_i // len(states_df)
+        rows.append(dict(fips='{}{:03d}'.format(states_df.loc[state, 'fips'],
+                                                 county_num),
+                         county='Synthetic {}'.format(county_num),
+                         state=state))
+        extra_i += 1
+    df = pd.DataFrame(rows[:n_locations])
+
+    # The real files also have rows that `get_and_save_data` filters out
+    special = [dict(fips=np.nan, county=np.nan, state=t) for t in TERRITORIES]
+    for state, state_fips in list(states_df['fips'].items())[:5]:
+        special.append(dict(fips='900' + state_fips[-2:], county='Unassigned',
+                            state=state))
+        special.append(dict(fips='800' + state_fips[-2:],
+                            county='Out of {}'.format(states_df.loc[state, 'abbr']),
+                            state=state))
+    return pd.concat([df, pd.DataFrame(special)], ignore_index=True)
+
+
+def make_jhu_dfs(n_locations, n_days, states_csv='data/states.csv',
+                 geo_json='data/geojson-counties-fips.json', seed=0):
+    """Make DataFrames shaped like the John Hopkins cases and deaths files
+
+    Args:
+        n_locations (int): Number of counties
+        n_days (int): Number of date columns, starting on Jan 22, 2020
+        seed (int, optional): Seed for the random numbers
+
+    Returns:
+        tuple: (pandas.DataFrame, pandas.DataFrame) cases and deaths
+
+    """
+    rng = np.random.default_rng(seed)
+    loc_df = _locations(n_locations, states_csv, geo_json)
+    n = len(loc_df)
+
+    fips_num = pd.to_numeric(loc_df['fips'])
+    meta = pd.DataFrame({
+        'UID': 84000000 + np.arange(n),
+        'iso2': 'US',
+        'iso3': 'USA',
+        'code3': 840,
+        'FIPS': fips_num.map(lambda f: '' if np.isnan(f) else '{:.1f}'.format(f)),
+        'Admin2': loc_df['county'],
+        'Province_State': loc_df['state'],
+        'Country_Region': 'US',
+        'Lat': rng.uniform(25, 49, n).round(8),
+        'Long_': rng.uniform(-124, -67, n).round(8),
+    })
+    meta['Combined_Key'] = (meta['Admin2'].fillna('') + ', '
+                            + meta['Province_State'] + ', US')
+
+    dates = ['{d.month}/{d.day}/{d:%y}'.format(d=FIRST_DATE + timedelta(days=i))
+             for i in range(n_days)]
+
+    # Cumulative counts from a noisy, slowly changing daily rate
+    pops = rng.integers(1000, 2000000, n)
+    base_rate = rng.uniform(0, 0.0005, n)
+    wave = 1 + np.sin(np.arange(n_days) / 60)[:, None]
+    daily = rng.poisson(pops * base_rate * wave).T
+    cases = daily.cumsum(axis=1).astype(np.int64)
+    deaths = (cases // 60).astype(np.int64)
+
+    cases_df = pd.concat([meta, pd.DataFrame(cases, columns=dates)], axis=1)
+    deaths_df = pd.concat(
+        [meta, pd.DataFrame({'Population': pops}),
+         pd.DataFrame(deaths, columns=dates)], axis=1)
+    return cases_df, deaths_df
+
+
+def write_jhu_csvs(cases_path, deaths_path, n_locations, n_days, **kwargs):
+    """Write the cases and deaths csv files, see `make_jhu_dfs`"""
+    cases_df, deaths_df = make_jhu_dfs(n_locations, n_days, **kwargs)
+    cases_df.to_csv(cases_path, index=False)
+    deaths_df.to_csv(deaths_path, index=False)
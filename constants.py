@@ -1,9 +1,38 @@
 LOG_LEVEL = 1  # There is currently only 1 logging level, could add more later though
-ACCEPTABLE_STALE_HOURS = 1  # How frequently the site will refresh it's own data
+MANIFEST_POLL_MINUTES = 10  # How frequently the site checks for new data
+FIGURE_CACHE_SIZE = 256  # Max number of figures/cards kept in memory per worker
+PREWARM_COUNTIES = 50  # Number of most viewed county cards built ahead of time
+IO_THREADS = 8  # Max downloads/uploads to run at once
 
 # Download the John Hopkins data directly from github
 CASES_FILE = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_US.csv'
 DEATHS_FILE = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_US.csv'
 
+# Days before the last saved date that are reprocessed in an incremental update
+WARM_UP_DAYS = 7
+
+# File format for `counties_df` and `states_df`. 'npy' files are memory-mapped
+# when loaded, 'pkl' is the old format and is read fully into memory
+CASES_FILE_FORMAT = 'npy'
+
+# Days the maps can average cases over, the first is the default
+MAP_WINDOWS = [7, 14, 28]
+
+# Simplified county geojson for the maps, see module/geo_simplify.py
+# level: (tolerance in degrees, decimal places kept, max mapbox zoom to use it)
+# Maps zoomed in more than every max zoom use the full resolution file
+GEO_LEVELS = {
+    'low': (0.05, 3, 4.0),
+    'medium': (0.004, 4, 6.5),
+}
+
 BUCKET = 'covid-283120.appspot.com'  # Only used when deployed to google cloud
 LOCAL_DATA = True  # Set to "False" before deploying
+
+# Requests to remote storage that fail with a transient error are retried,
+# waiting twice as long before each retry, see module/storage.py
+STORAGE_RETRIES = 3
+STORAGE_RETRY_SECS = 0.5
+
+# Bytes fetched per range read of a remote file, see `Storage.open`
+STORAGE_READ_BYTES = 2 ** 20
@@ -1,19 +1,50 @@
-import dash
-import dash_core_components as dcc
-import dash_html_components as html
-import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
+import gc
+import math
+import os
+from collections import Counter
 
-from module.fresh_data import FreshData
-from module.graphs_and_tables import trend_table, CasesGraph
-from module.maps import states_map, counties_map
+from module.pipeline import StageTimer
+
+# How long each phase of starting up takes. With gunicorn --preload this all
+# happens once in the master process, otherwise once in every worker
+startup = StageTimer()
+
+with startup.stage('imports'):
+    import dash
+    import dash_core_components as dcc
+    import dash_html_components as html
+    import dash_bootstrap_components as dbc
+    from dash.dependencies import Input, Output
+
+    from constants import MAP_WINDOWS, PREWARM_COUNTIES
+    from module.fresh_data import FreshData
+    from module.api import add_api_endpoints
+    from module.geo_assets import add_geo_endpoint
+    from module.graphs_and_tables import trend_table, CasesGraph
+    from module.maps import states_map, counties_map
+    from module.metrics import add_metrics_endpoint, metrics
+    from module.prerendered import PrerenderedCallbacks, ANY, dash_response_json
+    from module.prewarm import run_in_pool
 
 app = dash.Dash(external_stylesheets=[dbc.themes.UNITED])
 app.title = 'COVID-19 Hot Spots'
 server = app.server
 
 #### GLOBAL VARS ##############################################################
-fd = FreshData()
+fd = FreshData(startup)
+
+
+@server.before_request
+def start_refresher():
+    # Registered before every other hook. Prerendered responses are sent
+    # without touching `fd.snapshot`, so a worker can't rely on that to start
+    # polling for new data
+    fd.start_refresher_if_needed()
+
+
+add_metrics_endpoint(server, fd)
+add_geo_endpoint(server, fd.geo_assets)
+add_api_endpoints(server, fd)
 config = {'scrollZoom': False,
           'displayModeBar': False,
           'doubleClick': False}
@@ -48,99 +79,268 @@ def table_and_graph_card(title, table, graph):
     ], color='light', body=True)
 
 
-app.layout = dbc.Container([
-    # Title Row
-    dbc.Row([
-        dbc.Col([
-            html.H1("COVID-19 Hot Spots", style={'textAlign': 'center'}),
-        ])
-    ]),
-
-    # The top row has two cards, a graph of data for USA, and a map of US states
-    dbc.Row([
-        dbc.Col([
-            dbc.Card([
-                # Sort of a hacky way of making sure the data stays fresh(ish)
-                dcc.Interval(id='interval-component',
-                             # One hour in milliseconds
-                             interval=1 * 1000 * 60 * 60,
-                             n_intervals=0),
-                dbc.Row([
-                    html.Div(id='usa-card'),  # Graph of usa data
-                    dbc.Card([
-                        dcc.Graph(id='states-map', config=config),
-                        html.H5(
-                            'Click on a state or select from the dropdown to see state-view',
-                            style={'textAlign': 'center'}),
-                    ], color='light', inverse=False, body=True),
-                ], justify='center'),
-            ], color='secondary', body=True)
-        ], width='auto'),
-    ], justify='center', ),
-
-    # Second row (last row) has either one or two cards. One is a county-level
-    #   map, the other is a graph of data at the state or county level
-    dbc.Row([
-        dbc.Col([
-            dbc.Card([
-                # Row just for the state-dropdown optionally used to select
-                #   the state of choice
-                dbc.Row([
-                    dbc.Col([
-                        dcc.Dropdown(
-                            id='state-dropdown',
-                            options=[dict(value=s, label=s) for s in
-                                     fd.states_meta_df.index],
-                            placeholder='Select a state',
-                            clearable=False,
-                            style={"width": "180px",
-                                   "font-size": "large", }),
-                    ], width=3),
-                ], justify='center'),
-                dbc.Row([  # Row for the counties map and data card
-                    dcc.Loading([
+def usa_card(snap):
+    """Return the card with USA data
+
+    Args:
+        snap (module.fresh_data.Snapshot): Data to build it from
+
+    Returns:
+        dash_bootstrap_components.Card: Bootstrap card
+
+    """
+    usa_ser = snap.states.series('USA')
+    return table_and_graph_card('USA',
+                                trend_table(snap.trends_df.loc['USA']),
+                                CasesGraph.usa_graph(usa_ser))
+
+
+def states_map_figure(snap, days_back=0, window=MAP_WINDOWS[0]):
+    """Return the map of states
+
+    Args:
+        snap (module.fresh_data.Snapshot): Data to build the map from
+        days_back (int, optional): Show the map as of this many days before
+            the latest data
+        window (int, optional): Days to average the cases over
+
+    Returns:
+        dict: Plotly figure dict
+
+    """
+    date = snap.states.dates[snap.states.day(days_back)]
+    return states_map(snap.states_map_df_as_of(days_back, window), date)
+
+
+def counties_map_figure(snap, state, days_back=0, window=MAP_WINDOWS[0]):
+    """Return the map of counties in a state, or 'USA' for every county
+
+    Args:
+        snap (module.fresh_data.Snapshot): Data to build the map from
+        state (str): Name of the state
+        days_back (int, optional): Show the map as of this many days before
+            the latest data
+        window (int, optional): Days to average the cases over
+
+    Returns:
+        dict: Plotly figure dict
+
+    """
+    # The geojson is fetched (and cached) by the browser separately, so it
+    # is never parsed here
+    df = snap.state_counties_rows(state, days_back, window)
+    return counties_map(df, fd.geo_assets.url(state), fd.states_meta_df, state)
+
+
+def date_slider_marks(snap):
+    """Labels for the date slider, on the first of some of the months
+
+    The slider's value is the number of days before the latest data, as a
+    negative number, so the latest day is always 0.
+
+    Args:
+        snap (module.fresh_data.Snapshot):
+
+    Returns:
+        dict: Slider value to label
+
+    """
+    dates = snap.states.dates
+    last = len(dates) - 1
+    firsts = (dates.day == 1).nonzero()[0]
+    step = max(1, math.ceil(len(firsts) / 6))
+    return {int(i - last): dates[i].strftime('%b %Y') for i in firsts[::step]}
+
+
+def map_key(key, day_offset, window):
+    """Figure cache key for a map on the date slider
+
+    Maps of the latest day, averaged over the default window, use the same
+    key as the prewarmed maps.
+    """
+    if day_offset == 0 and window == MAP_WINDOWS[0]:
+        return key
+    return key, day_offset, window
+
+
+def state_card(snap, state):
+    """Return a card with the trend table and cases graph for a state
+
+    Args:
+        snap (module.fresh_data.Snapshot): Data to build the card from
+        state (str): Name of the state
+
+    Returns:
+        dash_bootstrap_components.Card: Bootstrap card
+
+    """
+    table = trend_table(snap.trends_df.loc[state])
+    ser = snap.states.series(state)
+    pop = snap.states.pop(state)
+    graph = CasesGraph.state_or_county_graph(ser, pop)
+    return table_and_graph_card(state, table, graph)
+
+
+def county_card(snap, fips):
+    """Return a card with the trend table and cases graph for a county
+
+    Args:
+        snap (module.fresh_data.Snapshot): Data to build the card from
+        fips (str): fips code of the county
+
+    Returns:
+        dash_bootstrap_components.Card: Bootstrap card, or an H4 if the
+        county has no reported cases
+
+    """
+    title = snap.counties.name(fips)
+    ser = snap.counties.series(fips)
+    if ser.sum() == 0:
+        return html.H4('No cases have been reported in {}'.format(title))
+
+    table = trend_table(snap.trends_df.loc[fips])
+    pop = snap.counties.pop(fips)
+    graph = CasesGraph.state_or_county_graph(ser, pop)
+    return table_and_graph_card(title, table, graph)
+
+
+def make_layout():
+    """Return the layout of the whole page"""
+    # Not `fd.snapshot`, this runs at import, in the gunicorn master with
+    # --preload, where the refresher thread must not be started
+    snap = fd.peek_snapshot()
+    return dbc.Container([
+        # Title Row
+        dbc.Row([
+            dbc.Col([
+                html.H1("COVID-19 Hot Spots", style={'textAlign': 'center'}),
+            ])
+        ]),
+
+        # The top row has two cards, a graph of data for USA, and a map of US states
+        dbc.Row([
+            dbc.Col([
+                dbc.Card([
+                    # Sort of a hacky way of making sure the data stays fresh(ish)
+                    dcc.Interval(id='interval-component',
+                                 # One hour in milliseconds
+                                 interval=1 * 1000 * 60 * 60,
+                                 n_intervals=0),
+                    dbc.Row([
+                        html.Div(id='usa-card'),  # Graph of usa data
                         dbc.Card([
-                            dcc.Graph(id='counties-map',
-                                      # TODO: DashBug report, doubleClick = False does nothing
-                                      config={'displayModeBar': False,
-                                              'doubleClick': False}),
-                        ], color='light', body=True),
-                    ], type='default'),
-                    dcc.Loading([
-                        html.Div(id='state-or-county-card')
-                    ], type='default'),
-                ], justify='center'),
-            ], color='secondary', body=True),
-        ], width='auto'),
-    ], id='county-row', justify='center'),
-
-    # Final row acts as the footer
-    dbc.Row([
-        dcc.Markdown("""
-            Built with [Plotly Dash](https://plotly.com/dash/). Data from 
-            [Johns Hopkins University](https://github.com/CSSEGISandData/COVID-19). 
-            Source code at [Github](https://github.com/icanhazcodeplz/covid-data). 
-            Inspiration from 
-            [The New York Times](https://www.nytimes.com/interactive/2020/us/coronavirus-us-cases.html).
-            """),
-    ], justify='center', )
-], fluid=True)
+                            dcc.Graph(id='states-map', config=config),
+                            # Moves every map back in time
+                            dcc.Slider(id='date-slider',
+                                       min=-(len(snap.states.dates) - 1),
+                                       max=0,
+                                       step=1,
+                                       value=0,
+                                       marks=date_slider_marks(snap),
+                                       updatemode='mouseup'),
+                            dcc.RadioItems(
+                                id='window-radio',
+                                options=[dict(value=w,
+                                              label=' {}-day average'.format(w))
+                                         for w in MAP_WINDOWS],
+                                value=MAP_WINDOWS[0],
+                                labelStyle={'display': 'inline-block',
+                                            'margin-right': '15px'},
+                                style={'textAlign': 'center'}),
+                            html.H5(
+                                'Click on a state or select from the dropdown to see state-view',
+                                style={'textAlign': 'center'}),
+                        ], color='light', inverse=False, body=True),
+                    ], justify='center'),
+                ], color='secondary', body=True)
+            ], width='auto'),
+        ], justify='center', ),
+
+        # Second row (last row) has either one or two cards. One is a county-level
+        #   map, the other is a graph of data at the state or county level
+        dbc.Row([
+            dbc.Col([
+                dbc.Card([
+                    # Row just for the state-dropdown optionally used to select
+                    #   the state of choice
+                    dbc.Row([
+                        dbc.Col([
+                            dcc.Dropdown(
+                                id='state-dropdown',
+                                options=[dict(value=s, label=s) for s in
+                                         fd.states_meta_df.index],
+                                placeholder='Select a state',
+                                clearable=False,
+                                style={"width": "180px",
+                                       "font-size": "large", }),
+                        ], width=3),
+                    ], justify='center'),
+                    dbc.Row([  # Row for the counties map and data card
+                        dcc.Loading([
+                            dbc.Card([
+                                dcc.Graph(id='counties-map',
+                                          # TODO: DashBug report, doubleClick = False does nothing
+                                          config={'displayModeBar': False,
+                                                  'doubleClick': False}),
+                            ], color='light', body=True),
+                        ], type='default'),
+                        dcc.Loading([
+                            html.Div(id='state-or-county-card')
+                        ], type='default'),
+                    ], justify='center'),
+                ], color='secondary', body=True),
+            ], width='auto'),
+        ], id='county-row', justify='center'),
+
+        # Final row acts as the footer
+        dbc.Row([
+            dcc.Markdown("""
+                Built with [Plotly Dash](https://plotly.com/dash/). Data from 
+                [Johns Hopkins University](https://github.com/CSSEGISandData/COVID-19). 
+                Source code at [Github](https://github.com/icanhazcodeplz/covid-data). 
+                Inspiration from 
+                [The New York Times](https://www.nytimes.com/interactive/2020/us/coronavirus-us-cases.html).
+                """),
+        ], justify='center', )
+    ], fluid=True)
+
+
+with startup.stage('layout'):
+    app.layout = make_layout()
 
 
 #### CALLBACKS ################################################################
 
 @app.callback(
-    [Output('usa-card', 'children'),
-     Output('states-map', 'figure')],
+    Output('usa-card', 'children'),
     [Input('interval-component', 'n_intervals')],
     prevent_initial_call=False)
 def update_usa_data(_):
     # Using the interval-component trigger on initial load ensures that the
     # data is fresh. This is a bit hacky, but it works well enough for this site
-    return (table_and_graph_card('USA',
-                                 trend_table(fd.states_df['USA']),
-                                 CasesGraph.usa_graph(fd.states_df['USA'])),
-            states_map(fd.states_map_df, fd.states_df.index[-1]))
+    return fd.cached('usa', 'USA', usa_card)
+
+
+@app.callback(
+    [Output('date-slider', 'min'),
+     Output('date-slider', 'marks')],
+    [Input('interval-component', 'n_intervals')],
+    prevent_initial_call=True)
+def update_date_slider(_):
+    # New data adds a day to the start of the slider
+    snap = fd.snapshot
+    return -(len(snap.states.dates) - 1), date_slider_marks(snap)
+
+
+@app.callback(
+    Output('states-map', 'figure'),
+    [Input('interval-component', 'n_intervals'),
+     Input('date-slider', 'value'),
+     Input('window-radio', 'value')],
+    prevent_initial_call=False)
+def update_states_map(_, day_offset, window):
+    return fd.cached('states_map', map_key('USA', day_offset, window),
+                     lambda snap: states_map_figure(snap, -day_offset, window))
 
 
 @app.callback(
@@ -161,15 +361,18 @@ def set_state_dropdown_from_map_click(clickData):
 
 @app.callback(
     Output('counties-map', 'figure'),
-    [Input('state-dropdown', 'value')],
+    [Input('state-dropdown', 'value'),
+     Input('date-slider', 'value'),
+     Input('window-radio', 'value')],
     prevent_initial_call=False)
-def update_counties_map_from_dropdown(value):
+def update_counties_map_from_dropdown(value, day_offset, window):
     if value is None:
         # Default to showing all counties in the US
         value = 'USA'
     # If a user selects a state, only show the counties for that state
-    return counties_map(
-        fd.counties_map_df, fd.counties_geo, fd.states_meta_df, value)
+    return fd.cached('counties_map', map_key(value, day_offset, window),
+                     lambda snap: counties_map_figure(
+                         snap, value, -day_offset, window))
 
 
 @app.callback(
@@ -184,26 +387,99 @@ def make_state_or_county_card(value, clickData):
         # for that state
         if value == 'USA':
             return None
-        title = value
-        table = trend_table(fd.states_df[value])
-        ser = fd.states_df[value]
-        pop = fd.state_pop_dict[value]
-        graph = CasesGraph.state_or_county_graph(ser, pop)
+        return fd.cached('state_card', value,
+                         lambda snap: state_card(snap, value))
 
     if trigger == 'counties-map':
         # If a county is clicked from the counties-map,
         # the state-or-county-card will display data from that county
         fips = clickData['points'][0]['location']
-        title = fd.fips_county_dict[fips]
-        if fd.counties_df[fips].sum() == 0:
-            return html.H4('No cases have been reported in {}'.format(title))
+        county_views[fips] += 1
+        return fd.cached('county_card', fips,
+                         lambda snap: county_card(snap, fips))
 
-        table = trend_table(fd.counties_df[fips])
-        ser = fd.counties_df[fips]
-        pop = fd.fips_pop_dict[fips]
-        graph = CasesGraph.state_or_county_graph(ser, pop)
 
-    return table_and_graph_card(title, table, graph)
+#### PREWARMING ###############################################################
+
+# How often each county card was asked for, the most viewed are prewarmed
+county_views = Counter()
+
+# How to build each view, and the Dash output, trigger and input value of the
+# callback that returns it (if it can be prerendered, see PrerenderedCallbacks).
+# Maps are prewarmed for the latest day and the default window
+VIEWS = {
+    'usa': (lambda snap, _: usa_card(snap),
+            'usa-card.children', ANY, lambda _: ANY),
+    'states_map': (lambda snap, _: states_map_figure(snap),
+                   'states-map.figure', ANY, lambda _: ANY),
+    'counties_map': (counties_map_figure,
+                     'counties-map.figure', 'state-dropdown.value',
+                     lambda state: state),
+    'state_card': (state_card,
+                   'state-or-county-card.children', 'state-dropdown.value',
+                   lambda state: state),
+    'county_card': (county_card, None, None, None),
+}
+
+
+def build_view(snap, task):
+    """Build a view, and serialize it if it can be prerendered
+
+    Runs in the prewarm pool processes.
+    """
+    view, key = task
+    build, output, _, _ = VIEWS[view]
+    value = build(snap, key)
+    raw = dash_response_json(output, value) if output else None
+    return value, raw
+
+
+def prewarm(snap):
+    """Build every state view and the most viewed county cards
+
+    Called by `fd` for each new snapshot before it is published. At startup
+    the views are built in a process pool, and on the refresher thread in
+    this process (see `run_in_pool`). Then they are put in the figure cache,
+    and the ones that can be are served prerendered.
+    """
+    tasks = [('usa', 'USA'), ('states_map', 'USA')]
+    for state in fd.states_meta_df.index:
+        tasks.append(('counties_map', state))
+        if state != 'USA':
+            tasks.append(('state_card', state))
+    tasks += [('county_card', fips)
+              for fips, _ in county_views.most_common(PREWARM_COUNTIES)
+              if fips in snap.counties]
+
+    entries = []
+    for (view, key), (value, raw) in zip(
+            tasks, run_in_pool(snap, tasks, build_view)):
+        fd.figure_cache.get_or_build((view, key, snap.load_time),
+                                     lambda: value)
+        _, output, trigger, input_value = VIEWS[view]
+        if raw is not None:
+            entries.append((output, trigger, input_value(key), raw))
+    prerendered.set_encoded_responses(entries)
+
+
+# Prerendered maps are only right while the other inputs are at these values
+prerendered = PrerenderedCallbacks(
+    defaults={'date-slider.value': 0, 'window-radio.value': MAP_WINDOWS[0]})
+prerendered.add_to_server(server)
+with startup.stage('prewarm'):
+    fd.add_snapshot_hook(prewarm)
+
+print('Startup of process {}:'.format(os.getpid()))
+startup.report()
+for phase, secs in startup.timings.items():
+    metrics.set_gauge('startup_seconds', secs,
+                      'Time spent on each phase of starting the app',
+                      phase=phase)
+
+# When gunicorn is run with --preload, everything loaded so far is created once
+# in the master process and shared copy-on-write with the workers. Freezing
+# keeps the garbage collector from touching (and so copying) those objects.
+gc.freeze()
 
 
 if __name__ == '__main__':
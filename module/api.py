@@ -0,0 +1,175 @@
+import gzip
+import hashlib
+import json
+
+import flask
+import numpy as np
+import pandas as pd
+
+API_PREFIX = '/api/v1/'
+MAX_API_LOCATIONS = 1000
+
+
+class ApiError(Exception):
+    """A bad request, the message is returned to the client"""
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(',') if v.strip()]
+    return [str(v) for v in value]
+
+
+def _request_params():
+    """Parameters from the query string, or from a json body for big batches"""
+    params = dict(flask.request.args)
+    if flask.request.method == 'POST':
+        body = flask.request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise ApiError('POST body must be a json object')
+        params.update(body)
+    return params
+
+
+def _date_slice(dates, start, end):
+    try:
+        start_i = 0 if start is None else dates.searchsorted(pd.Timestamp(start))
+        stop_i = (len(dates) if end is None
+                  else dates.searchsorted(pd.Timestamp(end), side='right'))
+    except ValueError as e:
+        raise ApiError('Bad date: {}'.format(e))
+    return start_i, stop_i
+
+
+def _rounded_lists(values, decimals):
+    """Rows of a float array as lists, with NaN as None (json null)"""
+    lists = np.round(values, decimals).tolist()
+    if np.isnan(values).any():
+        lists = [[None if x != x else x for x in row] for row in lists]
+    return lists
+
+
+def _series_json(store, locations, start, end, kind):
+    """New cases, 7-day average and 7-day average per 100k for `locations`
+
+    Args:
+        store (module.cases_store.CasesStore): `Snapshot.counties` or `.states`
+        locations (list): fips codes or state names
+        start (str): First date, e.g. '2021-01-01', or `None`
+        end (str): Last date, or `None`
+        kind (str): 'fips' or 'state', used as the key for each location
+
+    Returns:
+        dict:
+
+    """
+    try:
+        rows = store.indexer(locations)
+    except KeyError as e:
+        raise ApiError('Unknown {}: {}'.format(kind, ', '.join(e.args[0])))
+    start_i, stop_i = _date_slice(store.dates, start, end)
+
+    cases = store.cases[rows, start_i:stop_i].tolist()
+    ave = store.rolling_average(rows, start_i, stop_i)
+    ave_rate = ave / store.pops[rows, None] * 100000
+    ave_lists = _rounded_lists(ave, 2)
+    ave_rate_lists = _rounded_lists(ave_rate, 2)
+
+    def known(x):
+        # Missing names and populations are NaN, which isn't valid json
+        return None if pd.isna(x) else x
+
+    return [{kind: loc,
+             'name': known(store.names[r]),
+             'population': known(store.pops[r]) and int(store.pops[r]),
+             'new_cases': cases[i],
+             'ave_7day': ave_lists[i],
+             'ave_7day_per_100k': ave_rate_lists[i]}
+            for i, (loc, r) in enumerate(zip(locations, rows))]
+
+
+def cases_response(snap, params):
+    """Build the json for a request to the cases endpoint
+
+    Args:
+        snap (module.fresh_data.Snapshot):
+        params (dict): 'fips' and/or 'states' (comma separated strings or
+            lists), and optional 'start' and 'end' dates
+
+    Returns:
+        dict:
+
+    """
+    fips = _as_list(params.get('fips'))
+    states = _as_list(params.get('states'))
+    if not fips and not states:
+        raise ApiError('Give at least one of "fips" or "states"')
+    if len(fips) + len(states) > MAX_API_LOCATIONS:
+        raise ApiError('At most {} locations per request'.format(
+            MAX_API_LOCATIONS))
+
+    start, end = params.get('start'), params.get('end')
+    start_i, stop_i = _date_slice(snap.counties.dates, start, end)
+    out = dict(dates=[d.strftime('%Y-%m-%d')
+                      for d in snap.counties.dates[start_i:stop_i]],
+               locations=[])
+    if fips:
+        out['locations'] += _series_json(
+            snap.counties, fips, start, end, 'fips')
+    if states:
+        out['locations'] += _series_json(
+            snap.states, states, start, end, 'state')
+    return out
+
+
+def _json_response(obj, status=200, etag=None):
+    raw = json.dumps(obj, separators=(',', ':')).encode()
+    response = flask.Response(status=status, mimetype='application/json')
+    if 'gzip' in flask.request.headers.get('Accept-Encoding', '') and len(raw) > 1000:
+        response.set_data(gzip.compress(raw, 6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response.set_data(raw)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if etag:
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+
+def add_api_endpoints(server, fd):
+    """Serve the case data as json from `server`
+
+    GET or POST {API_PREFIX}cases with 'fips' and/or 'states', plus optional
+    'start' and 'end' dates (YYYY-MM-DD), e.g.
+
+        /api/v1/cases?fips=06037,17031&states=Texas&start=2021-01-01
+
+    Responses have an ETag that changes when the data does, so clients can
+    poll with If-None-Match, and are gzipped if the client accepts it.
+
+    Args:
+        server (flask.Flask): `app.server`
+        fd (module.fresh_data.FreshData):
+
+    """
+
+    @server.route(API_PREFIX + 'cases', methods=['GET', 'POST'])
+    def api_cases():
+        snap = fd.snapshot
+        try:
+            params = _request_params()
+            # Same data and same request means the same response. The version
+            # is the bundle's content hash, so every worker gives the same tag
+            key = json.dumps([snap.version, sorted(params.items())],
+                             default=str)
+            etag = '"{}"'.format(hashlib.sha256(key.encode()).hexdigest()[:32])
+            if etag in flask.request.headers.get('If-None-Match', ''):
+                response = flask.Response(status=304)
+                response.headers['ETag'] = etag
+                return response
+            return _json_response(cases_response(snap, params), etag=etag)
+        except ApiError as e:
+            return _json_response(dict(error=str(e)), status=400)
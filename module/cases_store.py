@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+
+class CasesStore:
+    """Compact store of the new cases per day for every location
+
+    Holds one int32 matrix with a row per location (so each location's cases
+    are contiguous), plus arrays of the population and display name of each
+    location in the same order. Locations are looked up through a pandas
+    Index, which is backed by arrays rather than a dict of Python objects.
+
+    Averages over any window ending on any day come from a matrix of the
+    cumulative cases, so they take two lookups and a subtraction per location
+    rather than a rolling sum.
+
+    If `cases_df` is memory-mapped from a Fortran ordered int32 .npy file (see
+    `BundleWriter.add_cases`) the matrix is a view of it, not a copy. The
+    same goes for `cumsum_df`.
+
+    Args:
+        cases_df (pandas.DataFrame): `counties_df` or `states_df`, index are
+            dates, columns are locations
+        pop_s (pandas.Series): Population, index are locations
+        name_s (pandas.Series): Display name, index are locations
+        cumsum_df (pandas.DataFrame, optional): Cumulative sum of `cases_df`,
+            see `cumulative_cases`. Calculated on first use if not given
+
+    """
+
+    def __init__(self, cases_df, pop_s, name_s, cumsum_df=None):
+        self.dates = cases_df.index
+        self.locations = pd.Index(cases_df.columns)
+        self.cases = cases_df.to_numpy().astype(np.int32, copy=False).T
+        self._cumsum_cache = None
+        if (cumsum_df is not None and cumsum_df.index.equals(self.dates)
+                and cumsum_df.columns.equals(self.locations)):
+            self._cumsum_cache = cumsum_df.to_numpy().T
+        self.pops = pop_s[~pop_s.index.duplicated()].reindex(
+            self.locations).to_numpy(dtype=np.float64)
+        self.names = name_s[~name_s.index.duplicated()].reindex(
+            self.locations).to_numpy(dtype=object)
+
+    def __contains__(self, location):
+        return location in self.locations
+
+    def _i(self, location):
+        return self.locations.get_loc(location)
+
+    def series(self, location):
+        """New cases per day for one location
+
+        Args:
+            location (str): fips or state name
+
+        Returns:
+            pandas.Series: Index are dates
+
+        """
+        return pd.Series(self.cases[self._i(location)], index=self.dates,
+                         name=location)
+
+    def pop(self, location):
+        return self.pops[self._i(location)]
+
+    def name(self, location):
+        return self.names[self._i(location)]
+
+    def indexer(self, locations):
+        """Row numbers of `locations` in `cases`
+
+        Raises:
+            KeyError: If any of the locations are unknown
+
+        """
+        rows = self.locations.get_indexer(locations)
+        if (rows == -1).any():
+            raise KeyError([l for l, r in zip(locations, rows) if r == -1])
+        return rows
+
+    def _cumsum(self):
+        # Column i is the sum of the first i + 1 days
+        if self._cumsum_cache is None:
+            self._cumsum_cache = np.cumsum(self.cases, axis=1, dtype=np.int64)
+        return self._cumsum_cache
+
+    def window_average(self, ends, window=7, rows=None):
+        """Average of the `window` days up to and including each day in `ends`
+
+        Args:
+            ends (numpy.ndarray): Days (indexes into `dates`)
+            window (int, optional): Days to average over
+            rows (numpy.ndarray, optional): Row numbers, from `indexer`.
+                Defaults to every location
+
+        Returns:
+            numpy.ndarray: Shape (locations, len(ends)). Days without a full
+            window of data before them are NaN
+
+        """
+        cumsum = self._cumsum()
+        ends = np.asarray(ends)
+        begins = ends - window  # The last day before the window
+        full = begins >= -1
+        ends, begins = ends[full], begins[full]
+
+        if rows is not None:
+            cumsum = cumsum[rows]
+        sums = cumsum[:, ends].astype(np.float64)
+        sums[:, begins >= 0] -= cumsum[:, begins[begins >= 0]]
+
+        ave = np.full((cumsum.shape[0], len(full)), np.nan)
+        ave[:, full] = sums / window
+        return ave
+
+    def rolling_average(self, rows, start, stop, window=7):
+        """Average of the `window` days up to each day, for many locations
+
+        Args:
+            rows (numpy.ndarray): Row numbers, from `indexer`
+            start (int): First day (index into `dates`)
+            stop (int): One past the last day
+            window (int, optional): Days to average over
+
+        Returns:
+            numpy.ndarray: Shape (len(rows), stop - start). Days without a full
+            window of data before them are NaN
+
+        """
+        return self.window_average(np.arange(start, stop), window, rows)
+
+    def day(self, days_back):
+        """Index into `dates` of the day `days_back` days before the last"""
+        return len(self.dates) - 1 - days_back
+
+    def nbytes(self):
+        """Bytes used by each component of the store
+
+        Returns:
+            dict: Component name to bytes
+
+        """
+        return dict(
+            cases=self.cases.nbytes,
+            cumsum=0 if self._cumsum_cache is None else self._cumsum_cache.nbytes,
+            dates=self.dates.memory_usage(deep=True),
+            locations=self.locations.memory_usage(deep=True),
+            pops=self.pops.nbytes,
+            names=pd.Series(self.names).memory_usage(deep=True, index=False),
+        )
+
+
+def cumulative_cases(cases_df):
+    """Cumulative sum of a new cases DataFrame, as int64
+
+    Args:
+        cases_df (pandas.DataFrame): `counties_df` or `states_df`
+
+    Returns:
+        pandas.DataFrame: Same index and columns as `cases_df`
+
+    """
+    return pd.DataFrame(np.cumsum(cases_df.to_numpy(), axis=0, dtype=np.int64),
+                        index=cases_df.index, columns=cases_df.columns)
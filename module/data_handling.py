@@ -1,108 +1,303 @@
 import pandas as pd
 import numpy as np
 import re
-import pickle
-from io import BytesIO, StringIO
-from datetime import datetime
+from io import BytesIO
+from datetime import datetime, timedelta
+import hashlib
 import json
+import urllib.error
+import urllib.request
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from constants import *
-if not LOCAL_DATA:
-    # Only needed when in running in google cloud
-    from google.cloud import storage
+from module.cases_store import cumulative_cases
+from module.geo_simplify import geo_file
+from module.pipeline import Pipeline, Stage, StageTimer
+from module.storage import default_storage
 
 
-class DataHandler:
-    """Load and save data from either google cloud bucket or covid-data/data
+def run_concurrently(*calls):
+    """Run I/O bound functions in threads and wait for all of them
+
+    Downloads and uploads spend nearly all their time waiting on the network
+    (or disk), so running them together takes about as long as the slowest
+    one rather than the sum of them. Each call gets its own pool, so calls can
+    safely be nested.
+
+    Args:
+        *calls (callable): Functions that take no arguments
+
+    Returns:
+        list: The return value of each call, in the same order
 
-    If `LOCAL_DATA` in the file "constants.py" is set to `True`, save and load
-    data to .../covid-data/data
+    Raises:
+        Exception: The first exception raised by any of the calls, after all
+            of them have finished
+
+    """
+    if len(calls) < 2:
+        return [call() for call in calls]
+    with ThreadPoolExecutor(min(IO_THREADS, len(calls))) as pool:
+        futures = [pool.submit(call) for call in calls]
+    return [f.result() for f in futures]
+
+
+class DataHandler:
+    """Load and save data through a storage backend
 
-    If `LOCAL_DATA` is set to `False`, save and load data to google cloud
-    storage in the bucket `BUCKET`, which is defined in "constants.py"
+    The backends are in "module/storage.py". By default data is kept in
+    covid-data/data if `LOCAL_DATA` in the file "constants.py" is `True`, or
+    in the google cloud storage bucket `BUCKET` if it is `False`. Another
+    backend can be picked without editing "constants.py" by setting the
+    environment variable `COVID_DATA_STORAGE` (e.g. to 'memory:' or
+    'http://127.0.0.1:8081') or by calling `use_storage`.
 
     This is in a class purely for orginizational purposes
     """
+    _storage = None
+    _storage_lock = Lock()
 
     @staticmethod
-    def _upload_string_blob(string, destination_blob_name):
-        """Uploads a string to the bucket."""
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET)
-        blob = bucket.blob(destination_blob_name)
+    def use_storage(storage):
+        """Save and load data with `storage` from now on
 
-        blob.upload_from_string(string)
-        print("String uploaded to {}.".format(destination_blob_name))
+        Args:
+            storage (module.storage.Storage): or `None` to go back to the
+                default backend
+
+        """
+        DataHandler._storage = storage
+
+    @staticmethod
+    def storage():
+        """The storage backend in use, made once and shared by every thread"""
+        if DataHandler._storage is None:
+            with DataHandler._storage_lock:
+                if DataHandler._storage is None:
+                    DataHandler._storage = default_storage()
+        return DataHandler._storage
+
+    @staticmethod
+    def _shared_dir():
+        directory = os.path.join(tempfile.gettempdir(), 'covid-data')
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    @staticmethod
+    def _work_dir(name):
+        """Directory for files the app and ETL keep for themselves
+
+        Next to the data when the backend keeps plain files (so
+        covid-data/data by default), otherwise in the shared temp directory.
+        """
+        root = DataHandler.storage().local_dir or DataHandler._shared_dir()
+        return os.path.join(root, name)
+
+    @staticmethod
+    def _write_npy(df, npy_path, index_path):
+        index = dict(
+            index=[str(i) for i in df.index],
+            index_name=df.index.name,
+            index_is_datetime=isinstance(df.index, pd.DatetimeIndex),
+            columns=[str(c) for c in df.columns],
+            columns_name=df.columns.name,
+        )
+        # Fortran order keeps the values for one location next to each other
+        # on disk, so reading a single column only touches that column's pages
+        values = np.asfortranarray(df.to_numpy())
+
+        # Write to a temp file and rename so a worker that has the old file
+        # memory-mapped never sees a half-written file
+        os.makedirs(os.path.dirname(npy_path) or '.', exist_ok=True)
+        with open(npy_path + '.tmp', 'wb') as f:
+            np.save(f, values)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(npy_path + '.tmp', npy_path)
+        os.replace(index_path + '.tmp', index_path)
+        return npy_path, index_path
 
     @staticmethod
-    def _upload_file_blob(file, destination_blob_name):
-        """Uploads a file blob to the bucket."""
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET)
-        blob = bucket.blob(destination_blob_name)
+    def _npy_labels(index):
+        """The DataFrame index and columns from a .json index sidecar"""
+        if index['index_is_datetime']:
+            df_index = pd.DatetimeIndex(index['index'], name=index['index_name'])
+        else:
+            df_index = pd.Index(index['index'], name=index['index_name'])
+        df_columns = pd.Index(index['columns'], name=index['columns_name'])
+        return df_index, df_columns
 
-        blob.upload_from_file(file)
-        print("{} uploaded to {}".format(destination_blob_name, BUCKET)) if LOG_LEVEL > 0 else None
+    @staticmethod
+    def _column_positions(df_columns, columns, file_name):
+        col_i = df_columns.get_indexer(columns)
+        if (col_i == -1).any():
+            raise KeyError('Columns not in "{}": {}'.format(
+                file_name, [c for c, i in zip(columns, col_i) if i == -1]))
+        return col_i
 
     @staticmethod
-    def _upload_df_as_csv_blob(df, name_prefix):
-        csv = StringIO()
-        df.to_csv(csv)
-        DataHandler._upload_string_blob(csv.getvalue(), '{}.csv'.format(name_prefix))
+    def _read_local_npy(npy_path, index_path, columns=None):
+        print('reading "{}"'.format(npy_path)) if LOG_LEVEL > 0 else None
+        with open(index_path) as f:
+            index = json.load(f)
+        values = np.load(npy_path, mmap_mode='r')
+        df_index, df_columns = DataHandler._npy_labels(index)
+
+        if columns is not None:
+            col_i = DataHandler._column_positions(df_columns, columns, npy_path)
+            # Only the pages for these columns are read from disk
+            values = np.asarray(values[:, col_i])
+            df_columns = df_columns[col_i]
+
+        return pd.DataFrame(values, index=df_index, columns=df_columns,
+                            copy=False)
 
     @staticmethod
-    def _download_csv_blob_as_df(name_prefix):
-        """Downloads a blob from the bucket."""
-        storage_client = storage.Client()
+    def load_json_file(file_prefix):
+        """Load a small json file, returns `None` if it doesn't exist"""
+        try:
+            data = DataHandler.storage().read('{}.json'.format(file_prefix))
+        except FileNotFoundError:
+            return None
+        return json.loads(data)
 
-        bucket = storage_client.bucket(BUCKET)
-        blob = bucket.blob('{}.csv'.format(name_prefix))
-        txt = blob.download_as_string()
-        return pd.read_csv(BytesIO(txt), index_col=0)
+    @staticmethod
+    def save_json_file(obj, file_prefix):
+        # Every backend replaces the object in one step, readers never see
+        # half a file
+        DataHandler.storage().write('{}.json'.format(file_prefix),
+                                    json.dumps(obj).encode())
 
     @staticmethod
-    def _upload_df_as_pkl_blob(df, name_prefix):
-        DataHandler._upload_file_blob(BytesIO(pickle.dumps(df)), '{}.pkl'.format(name_prefix))
+    def _remove_files(prefix, keep):
+        """Remove the stored files whose names start with `prefix`
+
+        Args:
+            prefix (str): e.g. 'bundles/'
+            keep (list): Names not to remove
+
+        """
+        storage = DataHandler.storage()
+        for name in storage.list(prefix):
+            if name not in keep:
+                storage.delete(name)
 
     @staticmethod
-    def _download_pkl_blob_as_df(name_prefix):
-        """Downloads a blob from the bucket."""
-        storage_client = storage.Client()
+    def load_manifest():
+        """The manifest of the latest published data, see `BundleWriter`
 
-        bucket = storage_client.bucket(BUCKET)
-        blob = bucket.blob('{}.pkl'.format(name_prefix))
-        txt = blob.download_as_string()
-        return pd.read_pickle(BytesIO(txt))
+        Returns:
+            dict: or `None` if nothing has been published
+
+        """
+        return DataHandler.load_json_file('manifest')
 
     @staticmethod
-    def _local_pkl_path(name):
-        return 'data/{}.pkl'.format(name)
+    def open_bundle(manifest):
+        """Fetch and unpack the bundle a manifest points to, unless already done
+
+        The bundle is fetched in one transfer and unpacked to a directory named
+        after its version, which every gunicorn worker on the machine shares
+        (the .npy files are memory-mapped from there, see `Bundle.load_cases`).
+        Other unpacked versions, apart from the one before this, are removed.
+        Workers still using them keep working.
+
+        Args:
+            manifest (dict): from `load_manifest`
+
+        Returns:
+            :Bundle
+
+        """
+        root = os.path.join(DataHandler._shared_dir(), 'bundles')
+        os.makedirs(root, exist_ok=True)
+        directory = os.path.join(root, manifest['version'])
+        if not os.path.isdir(directory):
+            storage = DataHandler.storage()
+            tmp_dir = tempfile.mkdtemp(prefix='.unpacking.', dir=root)
+            try:
+                zip_path = storage.local_path(manifest['bundle'])
+                if zip_path is None:
+                    zip_path = os.path.join(tmp_dir, 'bundle.zip')
+                    storage.download(manifest['bundle'], zip_path)
+                print('Unpacking "{}"'.format(
+                    manifest['bundle'])) if LOG_LEVEL > 0 else None
+                with zipfile.ZipFile(zip_path) as z:
+                    z.extractall(tmp_dir)
+                if zip_path.startswith(tmp_dir):
+                    os.remove(zip_path)
+                os.rename(tmp_dir, directory)
+            except OSError:
+                # Another worker unpacked it first
+                if not os.path.isdir(directory):
+                    raise
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+            keep = {manifest['version'], manifest.get('previous_version')}
+            for d in os.listdir(root):
+                if d not in keep and not d.startswith('.'):
+                    shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+        return Bundle(manifest, directory)
 
     @staticmethod
-    def _read_local_pkl(name):
-        file = DataHandler._local_pkl_path(name)
-        print('reading "{}"'.format(file)) if LOG_LEVEL > 0 else None
-        return pd.read_pickle(file)
+    def load_bundle_cases(manifest, names):
+        """Load some new cases DataFrames from a bundle, without fetching all of it
+
+        The ETL only needs `counties_df` and `states_df` from the last bundle,
+        not the cumulative sums and map dfs that are most of it. Only the
+        zip's directory and the files for `names` are read, from a remote
+        backend with range reads (see `Storage.open`), and nothing is
+        unpacked to disk.
+
+        Args:
+            manifest (dict): from `load_manifest`
+            names (list): e.g. ['counties_df', 'states_df']
+
+        Returns:
+            list: DataFrames, in the same order as `names`
+
+        """
+        print('Reading {} from "{}"'.format(
+            names, manifest['bundle'])) if LOG_LEVEL > 0 else None
+        dfs = []
+        with DataHandler.storage().open(manifest['bundle']) as f, \
+                zipfile.ZipFile(f) as z:
+            files = set(z.namelist())
+            for name in names:
+                if name + '.npy' in files:
+                    index = json.loads(z.read(name + '.index.json'))
+                    values = np.load(BytesIO(z.read(name + '.npy')))
+                    df_index, df_columns = DataHandler._npy_labels(index)
+                    dfs.append(pd.DataFrame(values, index=df_index,
+                                            columns=df_columns, copy=False))
+                else:
+                    dfs.append(pd.read_pickle(BytesIO(z.read(name + '.pkl'))))
+        return dfs
 
     @staticmethod
-    def _save_local_pkl(thing, name):
-        file = DataHandler._local_pkl_path(name)
-        pd.to_pickle(thing, file)
-        print('saved "{}" locally'.format(file)) if LOG_LEVEL > 0 else None
+    def raw_cache_dir():
+        """Directory where the downloaded John Hopkins csv files are kept"""
+        directory = DataHandler._work_dir('raw')
+        os.makedirs(directory, exist_ok=True)
+        return directory
 
     @staticmethod
-    def load_pkl_file(file_prefix):
-        if LOCAL_DATA:
-            return DataHandler()._read_local_pkl(file_prefix)
-        else:
-            return DataHandler()._download_pkl_blob_as_df(file_prefix)
+    def checkpoint_dir():
+        """Directory where the `Pipeline` checkpoints of the ETL are kept"""
+        return DataHandler._work_dir('checkpoints')
 
     @staticmethod
-    def save_pkl_file(obj, file_prefix):
-        if LOCAL_DATA:
-            return DataHandler()._save_local_pkl(obj, file_prefix)
-        else:
-            return DataHandler()._upload_df_as_pkl_blob(obj, file_prefix)
+    def startup_cache_dir():
+        """Directory for things the app makes once and reuses when it restarts"""
+        directory = DataHandler._work_dir('cache')
+        os.makedirs(directory, exist_ok=True)
+        return directory
 
     @staticmethod
     def load_states_csv():
@@ -111,55 +306,424 @@ class DataHandler:
                            dtype=dict(fips=str))
 
     @staticmethod
-    def load_counties_geo():
-        with open('./data/geojson-counties-fips.json') as f:
+    def load_counties_geo(level='full'):
+        """Load the county geojson at a level of detail, see `GEO_LEVELS`"""
+        with open(geo_file(level)) as f:
             counties_geo = json.load(f)
         return counties_geo
 
 
+class Bundle:
+    """One published version of all of the data the app loads
+
+    Made by `BundleWriter`, opened with `DataHandler.open_bundle`.
+
+    Args:
+        manifest (dict): see `BundleWriter.publish`
+        directory (str): Where the bundle's files were unpacked
+
+    """
+
+    def __init__(self, manifest, directory):
+        self.manifest = manifest
+        self.version = manifest['version']
+        self.directory = directory
+
+    def __contains__(self, name):
+        return name in self.manifest['files']
+
+    def load_cases(self, name, columns=None):
+        """Load a new cases DataFrame (e.g. `counties_df`)
+
+        .npy files are memory-mapped rather than read into memory, so only
+        the parts of the file that are used get paged in, and every process
+        that loads the same bundle shares one copy of it.
+
+        Args:
+            name (str): Name of the file, without an extension
+            columns (list, optional): Only load these columns
+
+        Returns:
+            :pandas.DataFrame
+
+        """
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path + '.npy'):
+            return DataHandler._read_local_npy(
+                path + '.npy', path + '.index.json', columns)
+        df = pd.read_pickle(path + '.pkl')
+        return df if columns is None else df[columns]
+
+    def load_pkl(self, name):
+        return pd.read_pickle(os.path.join(self.directory, name + '.pkl'))
+
+
+class BundleWriter:
+    """Collects the files for a new version of the data, then publishes them
+
+    Every file goes into one zip (the bundle), named after a hash of its
+    contents. The bundle is uploaded first and then "manifest.json" is
+    replaced to point at it, so readers either see all of the old data or
+    all of the new data, never a mix. Readers only need to poll the small
+    manifest to find out if there is new data.
+
+    Example:
+        writer = BundleWriter()
+        writer.add_cases(counties_df, 'counties_df')
+        writer.add_pkl(trends_df, 'trends_df')
+        writer.publish(sources=source_hashes)
+
+    """
+
+    def __init__(self):
+        self._dir = tempfile.mkdtemp(prefix='bundle.',
+                                     dir=DataHandler._shared_dir())
+        self._names = []
+
+    def add_cases(self, df, name):
+        """Add a new cases DataFrame, in the format set by `CASES_FILE_FORMAT`"""
+        path = os.path.join(self._dir, name)
+        if CASES_FILE_FORMAT == 'npy':
+            DataHandler._write_npy(df, path + '.npy', path + '.index.json')
+        else:
+            pd.to_pickle(df, path + '.pkl')
+        self._names.append(name)
+
+    def add_pkl(self, obj, name):
+        pd.to_pickle(obj, os.path.join(self._dir, name + '.pkl'))
+        self._names.append(name)
+
+    def publish(self, **fields):
+        """Upload the bundle, then point the manifest at it
+
+        Args:
+            **fields: Extra values to put in the manifest, e.g. `sources`
+
+        Returns:
+            dict: The new manifest. Has the `fields` plus 'version',
+            'bundle' (its name in covid-data/data or the bucket), 'files',
+            'created' and 'previous_version'
+
+        """
+        digest = hashlib.sha256()
+        zip_path = self._dir + '.zip'
+        try:
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
+                for f in sorted(os.listdir(self._dir)):
+                    path = os.path.join(self._dir, f)
+                    with open(path, 'rb') as file:
+                        digest.update(f.encode())
+                        digest.update(file.read())
+                    z.write(path, f)
+            version = digest.hexdigest()[:16]
+
+            previous = DataHandler.load_manifest() or {}
+            manifest = dict(
+                fields,
+                version=version,
+                bundle='bundles/{}.zip'.format(version),
+                files=self._names,
+                created=datetime.utcnow().isoformat(),
+                previous_version=previous.get('version'),
+            )
+            DataHandler.storage().write_file(manifest['bundle'], zip_path)
+            # Flipped last, this is what makes the new data visible
+            DataHandler.save_json_file(manifest, 'manifest')
+            print('Published version {} ({:.1f} MB)'.format(
+                version, os.path.getsize(zip_path) / 2 ** 20)
+            ) if LOG_LEVEL > 0 else None
+        finally:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+
+        # Readers that saw the previous manifest may still be fetching it
+        DataHandler._remove_files(
+            'bundles/', keep=[manifest['bundle'], previous.get('bundle')])
+        return manifest
+
+
+def fetch_raw_file(url):
+    """Download a file, unless the copy in `DataHandler.raw_cache_dir` is current
+
+    Uses the ETag and Last-Modified headers from the last download to make a
+    conditional request. If the server doesn't support those, the file is
+    downloaded and its content hash tells whether it changed.
+
+    Args:
+        url (str): URL of the file
+
+    Returns:
+        tuple: (str, str) Path to the local copy and its sha256 hash
+
+    """
+    cache_dir = DataHandler.raw_cache_dir()
+    name = hashlib.sha256(url.encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, name + '.csv')
+    meta_path = os.path.join(cache_dir, name + '.json')
+
+    meta = {}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    request = urllib.request.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            content = response.read()
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print('"{}" has not changed'.format(url)) if LOG_LEVEL > 0 else None
+            return path, meta['sha256']
+        raise
+
+    print('Downloaded "{}"'.format(url)) if LOG_LEVEL > 0 else None
+    meta = dict(etag=headers.get('ETag'),
+                last_modified=headers.get('Last-Modified'),
+                sha256=hashlib.sha256(content).hexdigest())
+    with open(path + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return path, meta['sha256']
+
+
+# Date columns in the John Hopkins csv files look like "1/22/20"
+DATE_RE = r'\d+/\d+/\d\d$'
+
+
 def load_raw_covid_file(file):
     """Read the John Hopkins csv files, do some preprocessing, and return a df
 
     Args:
-        file (str): URL of the file
+        file (str): Path or URL of the file
 
     Returns:
         :pandas.DataFrame
 
     """
     print('Loading "{}"'.format(file)) if LOG_LEVEL > 0 else None
-    df = pd.read_csv(file)
-    df = df.drop(
-        ['iso2', 'iso3', 'code3', 'Country_Region',
-         'Lat', 'Long_', 'Combined_Key'], axis='columns')
-    df = df.rename(
-        {'Admin2': 'county', 'Province_State': 'state', 'Population': 'pop',
-         'FIPS': 'fips', 'UID': 'uid'},
-        axis='columns')
-
-    def convert_fips_to_str(f):
-        # Convert fips to string and front fill zeros to get to 5 characters
-        try:
-            return str.zfill(str(int(f)), 5)
-        except ValueError:
-            return np.nan
-
-    df['fips'] = df['fips'].apply(convert_fips_to_str)
+    renames = {'Admin2': 'county', 'Province_State': 'state',
+               'Population': 'pop', 'FIPS': 'fips', 'UID': 'uid'}
+
+    # Read just the header first, so the unused columns are never parsed and
+    # the date columns can be given a compact dtype
+    columns = pd.read_csv(file, nrows=0).columns
+    usecols = [c for c in columns if c in renames or re.match(DATE_RE, c)]
+    dtype = {c: np.int32 for c in usecols if c not in renames}
+    dtype.update(UID=np.int64, FIPS=np.float64, Admin2=str,
+                 Province_State=str)
+
+    df = pd.read_csv(file, usecols=usecols, dtype=dtype)
+    df = df.rename(renames, axis='columns')
+
+    # Convert fips to string and front fill zeros to get to 5 characters
+    fips = df['fips']
+    df['fips'] = (fips.astype('Int64').astype(str).str.zfill(5)
+                  .where(fips.notna()))
     return df
 
 
-def get_and_save_data(_=None):
-    """Download data from John Hopkins, do some processing, and save as pickles
+# Columns in the John Hopkins dfs that aren't dates, after `load_raw_covid_file`
+META_COLUMNS = {'uid', 'fips', 'county', 'state', 'pop'}
+
+
+def _date_columns(df):
+    """Names of the columns in a John Hopkins df that are dates"""
+    return [c for c in df.columns if c not in META_COLUMNS]
+
+
+def _new_cases(df):
+    date_cols = _date_columns(df)
+    dates = pd.to_datetime(date_cols, format='%m/%d/%y')
+
+    # Only keep data from Feb 24 on (the first kept day needs the day before
+    # it to be diffed)
+    first_i = max(dates.searchsorted(datetime(year=2020, month=2, day=24)), 1)
+
+    values = df[date_cols].to_numpy(dtype=np.int64).T
+    values = values[first_i:] - values[first_i - 1:-1]
+    values = np.maximum(values, 0) #FIXME: Remove positive tests from previous day instead?
+    # Daily new cases fit in int32, which halves the size of the saved files
+    return pd.DataFrame(values.astype(np.int32), index=dates[first_i:],
+                        columns=df.index)
+
+
+def _make_map_df(df, map_df):
+    pop_s = map_df['pop']
+    pop_s = pop_s[~pop_s.index.duplicated()].reindex(df.columns)
+
+    # Only the last 7 days are needed for the average as of the last day
+    week_ave = df.to_numpy()[-7:].mean(axis=0)
+    ave_rate = week_ave / pop_s.to_numpy(dtype=float) * 100000
+    map_df['week_ave'] = pd.Series(week_ave, index=df.columns)
+    map_df['ave_rate'] = pd.Series(ave_rate, index=df.columns)
+    return map_df.reset_index()
+
+
+def _percent_change(old, new):
+    """Percent change from `old` to `new`, rounded to whole numbers
+
+    Going from 0 to anything above 0 counts as +100%.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.round((new - old) / old * 100, 0)
+    change = np.where(old == 0, np.where(new > 0, 100, 0), change)
+    return change.astype(np.int64)
+
+
+def _make_trends_df(df):
+    """Summary of recent trends for every location in a new cases df
 
     Args:
-        _: Empty variable. Was needed for the Google Cloud Function to work
+        df (pandas.DataFrame): `counties_df` or `states_df`
+
+    Returns:
+        pandas.DataFrame: Index are the columns of `df`. Columns are 'date'
+        (last date in `df`), 'cases' (new cases on that date), 'cases_ave'
+        (7-day average), and 'week_change' and 'two_week_change' (percent
+        change in the 7-day average from 7 and 14 days before)
 
     """
-    tot_deaths_df = load_raw_covid_file(DEATHS_FILE)
-    tot_cases_df = load_raw_covid_file(CASES_FILE)
-    uid_pop = tot_deaths_df[['uid', 'pop']].set_index('uid', drop=True)
-    tot_cases_df = tot_cases_df.join(uid_pop, on='uid')
+    values = df.to_numpy()
+    ave = values[-7:].mean(axis=0)
+    ave_week_ago = values[-14:-7].mean(axis=0)
+    ave_two_weeks_ago = values[-21:-14].mean(axis=0)
+    return pd.DataFrame(dict(
+        date=df.index[-1],
+        cases=values[-1],
+        cases_ave=ave,
+        week_change=_percent_change(ave_week_ago, ave),
+        two_week_change=_percent_change(ave_two_weeks_ago, ave),
+    ), index=df.columns)
+
+
+def _number_strs(nums, max_val_for_decimals=10):
+    """Format numbers for the map hover text
+
+    Numbers above `max_val_for_decimals` are rounded to a whole number, the
+    rest are rounded to one decimal place.
+
+    Args:
+        nums (pandas.Series):
+        max_val_for_decimals (int, optional):
+
+    Returns:
+        pandas.Series: Strings, same index as `nums`
+
+    """
+    nums = nums.astype(float)
+    big = nums > max_val_for_decimals
+    strs = nums.round(1).astype(str)
+    strs[big] = nums[big].round(0).astype(np.int64).astype(str)
+    return strs
+
+
+def _load_previous_data(manifest):
+    """Load the published `counties_df`, `states_df` and their history hash
+
+    Returns `None` if they are missing, see `_new_cases_stage`.
+    """
+    try:
+        counties_df, states_df = DataHandler.load_bundle_cases(
+            manifest, ['counties_df', 'states_df'])
+        return counties_df, states_df, manifest.get('history_hash')
+    except Exception as e:
+        print('Could not load previous data ({}), doing a full '
+              'rebuild'.format(e)) if LOG_LEVEL > 0 else None
+        return None
+
+
+def _history_hash(raw_df, last_date):
+    """Fingerprint of a raw John Hopkins df up to and including `last_date`
+
+    Only the warm-up days are compared by `_append_new_days`, so this is
+    saved with the data to catch John Hopkins revising an older day.
+
+    Args:
+        raw_df (pandas.DataFrame): from `_parse_cases`
+        last_date (datetime):
+
+    Returns:
+        str:
+
+    """
+    date_cols = _date_columns(raw_df)
+    dates = pd.to_datetime(date_cols, format='%m/%d/%y')
+    columns = ([c for c in raw_df.columns if c in META_COLUMNS]
+               + [c for c, d in zip(date_cols, dates) if d <= last_date])
+    rows = pd.util.hash_pandas_object(raw_df[columns], index=True)
+    h = hashlib.sha256('\0'.join(columns).encode())
+    h.update(rows.to_numpy().tobytes())
+    return h.hexdigest()
+
 
+def _drop_processed_dates(raw_df, last_date):
+    """Drop date columns from a raw John Hopkins df that are already processed
+
+    The `WARM_UP_DAYS` before `last_date` are kept so that the first new day
+    can be diffed, and so that the overlap can be checked against the
+    previously saved data.
+
+    Args:
+        raw_df (pandas.DataFrame): from `load_raw_covid_file`
+        last_date (datetime): Last date in the previously saved data
+
+    Returns:
+        :pandas.DataFrame
+
+    """
+    first_kept = last_date - timedelta(days=WARM_UP_DAYS)
+    date_cols = _date_columns(raw_df)
+    dates = pd.to_datetime(date_cols, format='%m/%d/%y')
+    drop = [c for c, d in zip(date_cols, dates) if d < first_kept]
+    return raw_df.drop(drop, axis='columns')
+
+
+def _append_new_days(old_df, new_df):
+    """Append the days in `new_df` that come after the last day in `old_df`
+
+    Returns `None` if the locations differ, or if the overlapping days do not
+    match exactly (e.g. John Hopkins revised recent numbers). In both cases
+    only a full rebuild gives the right answer.
+
+    Args:
+        old_df (pandas.DataFrame): Previously saved `counties_df` or `states_df`
+        new_df (pandas.DataFrame): Same, but only for the warm-up and new days
+
+    Returns:
+        :pandas.DataFrame
+
+    """
+    if not new_df.columns.equals(old_df.columns):
+        return None
+    overlap = new_df.index[new_df.index <= old_df.index[-1]]
+    if len(overlap) == 0:
+        return None
+    if not old_df.loc[overlap].equals(new_df.loc[overlap]):
+        return None
+    return pd.concat([old_df, new_df[new_df.index > old_df.index[-1]]])
+
+
+def _make_cases_dfs(tot_cases_df):
+    """Turn the raw cases into new cases per day for every state and county
+
+    Args:
+        tot_cases_df (pandas.DataFrame): from `load_raw_covid_file`, joined
+            with population
+
+    Returns:
+        tuple: (states_df, states_map_df, counties_df), `states_map_df` only
+        has the 'pop' column at this point
+
+    """
     state_cases_df = tot_cases_df.drop(
         ['uid', 'fips', 'county'], axis='columns')
     state_cases_df = state_cases_df.groupby(['state']).sum()
@@ -168,69 +732,234 @@ def get_and_save_data(_=None):
          'Northern Mariana Islands', 'Virgin Islands'], axis='rows')
     state_cases_df.loc['USA'] = state_cases_df.sum()
 
-    def new_cases(df):
-        date_cols_bool = [bool(re.match('\d*/\d*/\d\d', c)) for c in df.columns]
-        df = df.iloc[:, date_cols_bool].T
-        df = df.diff()[1:]
-        df = df.clip(lower=0) #FIXME: Remove positive tests from previous day instead?
-        df.index = pd.to_datetime(df.index)
-
-        # Only keep data from Feb 24 on
-        slice_i = datetime(year=2020, month=2, day=24)
-        return df[slice_i:]
-
     states_map_df = state_cases_df['pop'].to_frame('pop')
     state_cases_df = state_cases_df.drop('pop', axis='columns')
-    states_df = new_cases(state_cases_df)
+    states_df = _new_cases(state_cases_df)
 
     counties_df = tot_cases_df.dropna().set_index('fips', drop=True)
     counties_df = counties_df[~(counties_df['county'] == 'Unassigned')]
     counties_df = counties_df[~(counties_df['county'].str.contains('Out of'))]
-    counties_df = new_cases(counties_df)
+    counties_df = _new_cases(counties_df)
+    return states_df, states_map_df, counties_df
+
+
+def _parse_cases(file, tot_deaths_df):
+    """Load the raw cases and join the population from the deaths file"""
+    tot_cases_df = load_raw_covid_file(file)
+    uid_pop = tot_deaths_df[['uid', 'pop']].set_index('uid', drop=True)
+    return tot_cases_df.join(uid_pop, on='uid')
 
-    def make_map_df(df, map_df):
-        loc_pop_dict = map_df['pop'].to_dict()
-        ave_df = df.rolling(7, ).mean().dropna()
-        ave_rate_df = ave_df.apply(lambda s: s / loc_pop_dict[s.name] * 100000)
-        map_df['week_ave'] = ave_df.iloc[-1]
-        map_df['ave_rate'] = ave_rate_df.iloc[-1]
-        return map_df.reset_index()
 
+def _new_cases_stage(tot_cases_df, previous):
+    """New cases per day, appended to `previous` if possible
+
+    Args:
+        tot_cases_df (pandas.DataFrame): from `_parse_cases`
+        previous (tuple): (counties_df, states_df, history_hash) that were
+            saved by the last run, or `None` to process the whole history
+
+    Returns:
+        tuple: (states_df, states_pop_df, counties_df, history_hash), the
+        hash is from `_history_hash` as of the last day in `states_df`
+
+    """
+    result = None
+    if previous is not None:
+        prev_counties_df, prev_states_df, prev_history_hash = previous
+        last_date = min(prev_counties_df.index[-1], prev_states_df.index[-1])
+        if _history_hash(tot_cases_df, last_date) != prev_history_hash:
+            print('John Hopkins data up to {} has changed, doing a full '
+                  'rebuild'.format(last_date.date())) if LOG_LEVEL > 0 else None
+        else:
+            states_df, states_pop_df, counties_df = _make_cases_dfs(
+                _drop_processed_dates(tot_cases_df, last_date))
+            counties_df = _append_new_days(prev_counties_df, counties_df)
+            states_df = _append_new_days(prev_states_df, states_df)
+            if counties_df is not None and states_df is not None:
+                result = states_df, states_pop_df, counties_df
+            else:
+                print('Saved data does not match the new data, doing a full '
+                      'rebuild') if LOG_LEVEL > 0 else None
+    if result is None:
+        result = _make_cases_dfs(tot_cases_df)
+    return (*result, _history_hash(tot_cases_df, result[0].index[-1]))
+
+
+def _map_stats_stage(tot_deaths_df, counties_df, states_df, states_pop_df):
     counties_map_df = tot_deaths_df[['pop', 'county', 'state', 'fips']]
     counties_map_df = counties_map_df.set_index('fips', drop=True)
+    return (_make_map_df(counties_df, counties_map_df),
+            _make_map_df(states_df, states_pop_df.copy()))
 
-    counties_map_df = make_map_df(counties_df, counties_map_df)
-    states_map_df = make_map_df(states_df, states_map_df)
 
-    def custom_number_str(num, max_val_for_decimals=10):
-        if num > max_val_for_decimals:
-            return str(int(round(num, 0)))
-        else:
-            return str(round(num, 1))
+def _trends_stage(states_df, counties_df):
+    # States and counties share one table, fips and state names don't clash
+    return pd.concat([_make_trends_df(states_df), _make_trends_df(counties_df)])
+
+
+def counties_map_text(counties_map_df):
+    """Hover text for the counties map
+
+    Args:
+        counties_map_df (pandas.DataFrame): Columns must include 'county',
+            'state', 'week_ave' and 'ave_rate'
+
+    Returns:
+        pandas.Series:
+
+    """
+    return ('<b>' + counties_map_df['county'].astype(str) + ' County, '
+            + counties_map_df['state'].astype(str)
+            + '</b><br>Avg. Daily Cases: '
+            + _number_strs(counties_map_df['week_ave'])
+            + '<br>             Per 100k: '
+            + _number_strs(counties_map_df['ave_rate']))
+
+
+def states_map_text(states_map_df, states):
+    """Hover text for the states map
+
+    Args:
+        states_map_df (pandas.DataFrame): Columns must include 'week_ave' and
+            'ave_rate'
+        states (pandas.Series): Names of the states, in the same order
 
-    counties_map_df['text'] = [
-        '<b>{} County, {}</b><br>Avg. Daily Cases: {}<br>             Per 100k: {}'.format(
-            tup.county,
-            tup.state,
-            custom_number_str(tup.week_ave),
-            custom_number_str(tup.ave_rate)
-        ) for tup in counties_map_df.itertuples()]
+    Returns:
+        pandas.Series:
 
-    states_map_df['text'] = [
-        '<b>{}</b><br>Avg. Daily Cases: {}<br>             Per 100k: {}'.format(
-            tup.state,
-            custom_number_str(tup.week_ave),
-            custom_number_str(tup.ave_rate)
-        ) for tup in states_map_df.itertuples()]
+    """
+    return ('<b>' + states.astype(str)
+            + '</b><br>Avg. Daily Cases: '
+            + _number_strs(states_map_df['week_ave'])
+            + '<br>             Per 100k: '
+            + _number_strs(states_map_df['ave_rate']))
+
+
+def _text_stage(counties_stats_df, states_stats_df):
+    """Add the hover text to the map dfs"""
+    counties_map_df = counties_stats_df.copy()
+    counties_map_df['text'] = counties_map_text(counties_map_df)
+
+    states_map_df = states_stats_df.copy()
+    states_map_df['text'] = states_map_text(
+        states_map_df, states_map_df['state'])
+    return counties_map_df, states_map_df
+
+
+def _cumsum_stage(counties_df, states_df):
+    # Lets the app average any window on any day without a rolling sum
+    return cumulative_cases(counties_df), cumulative_cases(states_df)
+
+
+# The processing done by `get_and_save_data`. The inputs 'deaths_file',
+# 'cases_file' and 'previous' are added before these are run
+ETL_STAGES = [
+    Stage('parse_deaths', load_raw_covid_file,
+          ['deaths_file'], ['tot_deaths_df'],
+          constants=dict(DATE_RE=DATE_RE)),
+    Stage('parse_cases', _parse_cases,
+          ['cases_file', 'tot_deaths_df'], ['tot_cases_df'],
+          uses=[load_raw_covid_file],
+          constants=dict(DATE_RE=DATE_RE)),
+    Stage('new_cases', _new_cases_stage,
+          ['tot_cases_df', 'previous'],
+          ['states_df', 'states_pop_df', 'counties_df', 'history_hash'],
+          uses=[_make_cases_dfs, _new_cases, _history_hash,
+                _drop_processed_dates, _append_new_days, _date_columns],
+          constants=dict(WARM_UP_DAYS=WARM_UP_DAYS,
+                         META_COLUMNS=META_COLUMNS)),
+    Stage('map_stats', _map_stats_stage,
+          ['tot_deaths_df', 'counties_df', 'states_df', 'states_pop_df'],
+          ['counties_stats_df', 'states_stats_df'],
+          uses=[_make_map_df]),
+    Stage('trends', _trends_stage,
+          ['states_df', 'counties_df'], ['trends_df'],
+          uses=[_make_trends_df, _percent_change]),
+    Stage('text', _text_stage,
+          ['counties_stats_df', 'states_stats_df'],
+          ['counties_map_df', 'states_map_df'],
+          uses=[_number_strs, counties_map_text, states_map_text]),
+    Stage('cumsum', _cumsum_stage,
+          ['counties_df', 'states_df'],
+          ['counties_cumsum_df', 'states_cumsum_df'],
+          uses=[cumulative_cases]),
+]
+
+
+def get_and_save_data(_=None, full_rebuild=False):
+    """Download data from John Hopkins, do some processing, and publish it
+
+    Everything the app loads is published together as one bundle, see
+    `BundleWriter`. If neither John Hopkins file has changed since the data
+    was last published, nothing is processed or saved.
+
+    The processing is split into the `ETL_STAGES`, and what each stage makes
+    is checkpointed in `DataHandler.checkpoint_dir`. A stage only runs if its
+    code or its inputs changed since the checkpoint was made, so rerunning
+    after fixing a later stage doesn't parse the files again.
+
+    By default only the days that are not already in the saved `counties_df`
+    and `states_df` are processed (plus a warm-up window), and then appended.
+    If there is no saved data, or John Hopkins changed any day that was
+    already processed (checked with the `history_hash` in the manifest), this
+    falls back to processing the whole history.
 
-    DataHandler.save_pkl_file(counties_df, 'counties_df')
-    DataHandler.save_pkl_file(counties_map_df, 'counties_map_df')
+    Args:
+        _: Empty variable. Was needed for the Google Cloud Function to work
+        full_rebuild (bool, optional): If True, always reprocess the whole
+            history
 
-    DataHandler.save_pkl_file(states_df, 'states_df')
-    DataHandler.save_pkl_file(states_map_df, 'states_map_df')
-    return f'Completed'
+    """
+    timer = StageTimer()
+    with timer.stage('download'):
+        (deaths_path, deaths_hash), (cases_path, cases_hash) = run_concurrently(
+            lambda: fetch_raw_file(DEATHS_FILE),
+            lambda: fetch_raw_file(CASES_FILE))
+
+    # Hashes of the files the published data was made from
+    source_hashes = dict(deaths=deaths_hash, cases=cases_hash)
+    manifest = DataHandler.load_manifest()
+    saved_hashes = manifest and manifest.get('sources')
+    if not full_rebuild and source_hashes == saved_hashes:
+        print('John Hopkins data has not changed') if LOG_LEVEL > 0 else None
+        timer.report()
+        return 'No new data'
+
+    pipeline = Pipeline(DataHandler.checkpoint_dir(), timer)
+    pipeline.add_input('deaths_file', deaths_hash, lambda: deaths_path)
+    pipeline.add_input('cases_file', cases_hash, lambda: cases_path)
+    # The saved data is identified by the files it was made from
+    if full_rebuild or saved_hashes is None:
+        pipeline.add_input('previous', 'none', lambda: None)
+    else:
+        previous_key = json.dumps(
+            [saved_hashes, manifest.get('history_hash')], sort_keys=True)
+        pipeline.add_input('previous', previous_key,
+                           lambda: _load_previous_data(manifest))
+    pipeline.run(*ETL_STAGES)
+
+    cases_files = ['counties_df', 'states_df', 'counties_cumsum_df',
+                   'states_cumsum_df']
+    pkl_files = ['counties_map_df', 'states_map_df', 'trends_df']
+    values = {name: pipeline.get(name) for name in cases_files + pkl_files}
+    with timer.stage('save'):
+        writer = BundleWriter()
+        run_concurrently(
+            *[lambda name=name: writer.add_cases(values[name], name)
+              for name in cases_files],
+            *[lambda name=name: writer.add_pkl(values[name], name)
+              for name in pkl_files])
+        # The sources are in the manifest, which is saved last, so a failed
+        # save means the next run tries again
+        writer.publish(sources=source_hashes,
+                       history_hash=pipeline.get('history_hash'),
+                       last_date=str(values['states_df'].index[-1].date()))
+
+    timer.report()
+    return 'Completed'
 
 
 if __name__ == '__main__':
-    get_and_save_data()
+    import sys
+    get_and_save_data(full_rebuild='--full-rebuild' in sys.argv)
 
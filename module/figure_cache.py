@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class FigureCache:
+    """Bounded LRU cache for figures, tables and cards built from FreshData
+
+    Keys should include the data version (`FreshData.last_load_time`) so that
+    entries built from old data are never returned. `FreshData` also clears
+    the cache whenever it loads new data so old entries don't hold memory.
+
+    Args:
+        max_size (int): Maximum number of entries to keep
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_build(self, key, build):
+        """Return the cached value for `key`, calling `build()` on a miss
+
+        Args:
+            key (tuple): Hashable key, e.g. (view, state or fips, data version)
+            build (callable): Takes no arguments and returns the value to cache
+
+        Returns:
+            The cached or newly built value
+
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # Build outside of the lock, figures can take a while to make
+        value = build()
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit/miss counters for the cache
+
+        Returns:
+            dict: 'hits', 'misses', 'size' and 'max_size'
+
+        """
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._entries), max_size=self.max_size)
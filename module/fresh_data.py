@@ -1,55 +1,404 @@
+import hashlib
+import os
+import time
 from datetime import datetime
 
+import numpy as np
+from threading import Lock, Thread
+
 from constants import *
-from module.data_handling import DataHandler
+from module.cases_store import CasesStore
+from module.data_handling import (DataHandler, counties_map_text,
+                                  run_concurrently, states_map_text)
+from module.figure_cache import FigureCache
+from module.geo_assets import GeoAssets
+from module.geo_simplify import geo_file, geo_level_for_zoom
+from module.metrics import metrics
+from module.pipeline import StageTimer
+
+
+class Snapshot:
+    """All of the data that changes when John Hopkins publishes new numbers
+
+    A snapshot is completely built before `FreshData` publishes it, and is
+    never modified afterwards. Anything read from one snapshot is consistent
+    with everything else read from it.
+
+    Args:
+        states_meta_df (pandas.DataFrame): from `DataHandler.load_states_csv`
+        states_geo (callable): Takes no arguments and returns the dict from
+            `FreshData._index_geo_by_state`. Only called when geojson is
+            needed
+        bundle (module.data_handling.Bundle): The published data to load
+
+    """
+
+    def __init__(self, states_meta_df, states_geo, bundle):
+        self._states_geo = states_geo
+        self.version = bundle.version
+
+        def load_cumsum(name):
+            # Bundles published before the ETL made these don't have them,
+            # `CasesStore` calculates them instead
+            return bundle.load_cases(name) if name in bundle else None
+
+        # The files are all on local disk by now, read them at once
+        (self.counties_map_df, self.counties_df, self.states_df,
+         self.states_map_df, self.trends_df, counties_cumsum_df,
+         states_cumsum_df) = run_concurrently(
+            lambda: bundle.load_pkl('counties_map_df'),
+            lambda: bundle.load_cases('counties_df'),
+            lambda: bundle.load_cases('states_df'),
+            lambda: bundle.load_pkl('states_map_df'),
+            lambda: bundle.load_pkl('trends_df'),
+            lambda: load_cumsum('counties_cumsum_df'),
+            lambda: load_cumsum('states_cumsum_df'))
+
+        tmp_df = self.counties_map_df.set_index('fips', drop=True)
+        self.counties = CasesStore(
+            self.counties_df, tmp_df['pop'],
+            tmp_df.county + ' County, ' + tmp_df.state, counties_cumsum_df)
+        self._state_counties_map_dfs = {
+            state: df for state, df in self.counties_map_df.groupby('state')}
+
+        self.states_map_df = self.states_map_df.set_index('state', drop=True)
+        self.states_map_df = self.states_map_df.join(states_meta_df['abbr'])
+
+        self.states = CasesStore(
+            self.states_df, self.states_map_df['pop'],
+            self.states_map_df.index.to_series(), states_cumsum_df)
+        self.load_time = datetime.now()
+
+    @staticmethod
+    def _as_of(map_df, store, locations, days_back, window):
+        """Copy of a map df with the averages for another day and window"""
+        if days_back == 0 and window == MAP_WINDOWS[0]:
+            # What the ETL saved
+            return map_df
+        rows = store.locations.get_indexer(locations)
+        ave = store.window_average([store.day(days_back)], window)[:, 0]
+        map_df = map_df.copy()
+        map_df['week_ave'] = np.where(rows >= 0, ave[rows], np.nan)
+        map_df['ave_rate'] = (map_df['week_ave']
+                              / map_df['pop'].astype(float) * 100000)
+        return map_df
+
+    def states_map_df_as_of(self, days_back=0, window=MAP_WINDOWS[0]):
+        """`states_map_df` as of an earlier day, or averaged over another window
+
+        Args:
+            days_back (int, optional): Days before the latest day
+            window (int, optional): Days to average the cases over, one of
+                `MAP_WINDOWS`
+
+        Returns:
+            :pandas.DataFrame
+
+        """
+        df = self._as_of(self.states_map_df, self.states,
+                         self.states_map_df.index, days_back, window)
+        if df is not self.states_map_df:
+            df['text'] = states_map_text(df, df.index.to_series())
+        return df
+
+    def state_counties_rows(self, state, days_back=0, window=MAP_WINDOWS[0]):
+        """County map rows for a single state, without any geojson
+
+        The rows are looked up from an index built when the data is loaded, so
+        nothing is copied or filtered per call for the latest day.
+
+        Args:
+            state (str): Name of the state, or 'USA' for every county
+            days_back (int, optional): Days before the latest day
+            window (int, optional): Days to average the cases over, one of
+                `MAP_WINDOWS`
+
+        Returns:
+            pandas.DataFrame: The rows of `counties_map_df` for the counties
+            in `state`
+
+        """
+        if state == 'USA':
+            df = self.counties_map_df
+        else:
+            df = self._state_counties_map_dfs.get(
+                state, self.counties_map_df.iloc[0:0])
+        as_of_df = self._as_of(df, self.counties, df['fips'], days_back, window)
+        if as_of_df is not df:
+            as_of_df['text'] = counties_map_text(as_of_df)
+        return as_of_df
+
+    def state_counties(self, state, days_back=0, window=MAP_WINDOWS[0]):
+        """County geojson and county map rows for a single state
+
+        The geojson is simplified to suit the zoom level of the state's map.
+        Using it parses the geojson files if they haven't been already, use
+        `state_counties_rows` when only the rows are needed.
+
+        Args:
+            state (str): Name of the state, or 'USA' for every county
+            days_back (int, optional): Days before the latest day
+            window (int, optional): Days to average the cases over, one of
+                `MAP_WINDOWS`
+
+        Returns:
+            tuple: (dict, pandas.DataFrame) the geojson and the rows from
+            `state_counties_rows`
+
+        """
+        return (self._states_geo()[state],
+                self.state_counties_rows(state, days_back, window))
 
 
 class FreshData:
     """Single class to access all the data needed in this app.
 
     John Hopkins updates their data once a day. I am using a Google Cloud
-    Function to pull the data and create four files (see the function
+    Function to pull the data and create the files (see the function
     `get_and_save_data`) that are then saved to a bucket in Google Cloud
     Storage. This app is hosted using Google App Engine. It is served using
     Gunicorn. Because Gunicorn keeps global variables in memory, I needed a way
      to force some variables to update when there is fresh data avaible in
-    Cloud Storage. This class does that by checking the `last_refresh_date`
-    before returning the attributes, and pulls fresh data from the bucket if needed.
+    Cloud Storage. This class does that with a background thread that checks
+    the small manifest of the published data every `MANIFEST_POLL_MINUTES`.
+    Only when its version changes is the new bundle fetched and a new
+    `Snapshot` built and swapped in, so requests never wait on a download and
+    never see half-loaded data.
+
+    Callbacks should grab `snapshot` once and read everything from it.
+
+    The county geojson is only parsed if something needs it, the maps get it
+    from `geo_assets`, which are cached between runs.
+
+    Args:
+        timer (module.pipeline.StageTimer, optional): Loading the 'geo' and
+            the 'data' are timed in this
 
     """
 
-    def __init__(self):
+    def __init__(self, timer=None):
+        timer = timer or StageTimer()
         self.states_meta_df = DataHandler.load_states_csv()
-        self.counties_geo = DataHandler.load_counties_geo()
-
-        self._load_dynamic_data()
-
-    def _load_dynamic_data(self):
-        self._counties_map_df = DataHandler.load_pkl_file('counties_map_df')
-        self._counties_df = DataHandler.load_pkl_file('counties_df')
-
-        tmp_df = self._counties_map_df.set_index('fips', drop=True)
-        self.fips_pop_dict = tmp_df['pop'].to_dict()
-        self.fips_county_dict = (
-                tmp_df.county + ' County, ' + tmp_df.state).to_dict()
-
-        self._states_df = DataHandler.load_pkl_file('states_df')
-        self._states_map_df = DataHandler.load_pkl_file('states_map_df')
-        self._states_map_df = self._states_map_df.set_index('state', drop=True)
-        self._states_map_df = self._states_map_df.join(self.states_meta_df['abbr'])
-
-        self.state_pop_dict = self._states_map_df['pop'].to_dict()
-        self.last_load_time = datetime.now()
-
-    def _refresh_if_needed(self):
-        stale_secs = (datetime.now() - self.last_load_time).total_seconds()
-        stale_hours = stale_secs / 3600
-        if stale_hours > ACCEPTABLE_STALE_HOURS:
-            print('Refreshing data at {}'.format(datetime.now()))
-            self._load_dynamic_data()
-            return True
-        else:
+        self._states_geo = None
+        self._states_geo_lock = Lock()
+        with timer.stage('geo'):
+            self.geo_assets = GeoAssets.cached(
+                DataHandler.startup_cache_dir(), self._geo_version(),
+                lambda: self.states_geo)
+        self.figure_cache = FigureCache(FIGURE_CACHE_SIZE)
+
+        with timer.stage('data'):
+            self._snapshot = self._load_dynamic_data()
+        self._snapshot_hooks = []
+        self._refresher_pid = None
+        self._refresher_lock = Lock()
+
+    @staticmethod
+    def _index_geo_by_state(states_meta_df):
+        """Make a county FeatureCollection for each state, and for 'USA'
+
+        Each one uses the level of detail (see `GEO_LEVELS`) that suits the
+        zoom of that state's map. The features are shared between the states,
+        not copied.
+
+        Args:
+            states_meta_df (pandas.DataFrame): from `DataHandler.load_states_csv`
+
+        Returns:
+            dict: Keys are state names, values are geojson dicts
+
+        """
+        zooms = states_meta_df['zoom']
+        levels = {state: geo_level_for_zoom(z) for state, z in zooms.items()}
+        geos = {level: DataHandler.load_counties_geo(level)
+                for level in set(levels.values())}
+
+        states_geo = {'USA': geos[levels['USA']]}
+        fips_state_dict = {
+            fips: state for state, fips in states_meta_df['fips'].items()
+            if state != 'USA'}
+        for state in fips_state_dict.values():
+            geo = geos[levels[state]]
+            states_geo[state] = {k: v for k, v in geo.items() if k != 'features'}
+            states_geo[state]['features'] = []
+        for level, geo in geos.items():
+            for f in geo['features']:
+                state = fips_state_dict.get(f['properties']['STATE'])
+                if state is not None and levels[state] == level:
+                    states_geo[state]['features'].append(f)
+        return states_geo
+
+    def _geo_version(self):
+        """Hash of the geojson files used and the states' map settings"""
+        levels = {geo_level_for_zoom(z) for z in self.states_meta_df['zoom']}
+        digest = hashlib.sha256(self.states_meta_df.to_csv().encode())
+        for level in sorted(levels):
+            with open(geo_file(level), 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()[:16]
+
+    @property
+    def states_geo(self):
+        """County geojson for each state, parsed on first use
+
+        Returns:
+            dict: see `_index_geo_by_state`
+
+        """
+        if self._states_geo is None:
+            with self._states_geo_lock:
+                if self._states_geo is None:
+                    self._states_geo = self._index_geo_by_state(
+                        self.states_meta_df)
+        return self._states_geo
+
+    @staticmethod
+    def _load_manifest():
+        manifest = DataHandler.load_manifest()
+        if manifest is None:
+            raise FileNotFoundError(
+                'No data has been published yet, run '
+                '"python3 -m module.data_handling" first')
+        return manifest
+
+    def _load_dynamic_data(self, manifest=None):
+        if manifest is None:
+            manifest = self._load_manifest()
+        return Snapshot(self.states_meta_df, lambda: self.states_geo,
+                        DataHandler.open_bundle(manifest))
+
+    def refresh(self, force=False):
+        """Swap in a new snapshot if newer data has been published
+
+        Args:
+            force (bool, optional): Load the data even if it hasn't changed
+
+        Returns:
+            bool: True if a new snapshot was swapped in
+
+        """
+        manifest = self._load_manifest()
+        if not force and manifest['version'] == self._snapshot.version:
             return False
+        print('Refreshing data at {}'.format(datetime.now()))
+        start = time.perf_counter()
+        snapshot = self._load_dynamic_data(manifest)
+        metrics.observe('fresh_data_refresh_seconds',
+                        time.perf_counter() - start,
+                        'Time to load a new snapshot of the data')
+        # Everything in the cache was built from the old data
+        self.figure_cache.clear()
+        for hook in self._snapshot_hooks:
+            hook(snapshot)
+        # Assigning an attribute is atomic, readers see either the old or the
+        # new snapshot
+        self._snapshot = snapshot
+        return True
+
+    def add_snapshot_hook(self, hook):
+        """Call `hook(snapshot)` for every new snapshot, before publishing it
+
+        It is also called right away with the current snapshot.
+
+        Args:
+            hook (callable): Takes a `Snapshot`
+
+        """
+        self._snapshot_hooks.append(hook)
+        hook(self._snapshot)
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(MANIFEST_POLL_MINUTES * 60)
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the old snapshot and try again next time
+                print('Refreshing data failed: {}'.format(e))
+
+    def start_refresher_if_needed(self):
+        """Start the thread that refreshes the data, unless already running
+
+        Call it when serving a request. Threads don't survive a fork, so each
+        gunicorn worker needs its own, and the master (with --preload) must
+        not start one.
+        """
+        if self._refresher_pid == os.getpid():
+            return
+        with self._refresher_lock:
+            if self._refresher_pid != os.getpid():
+                Thread(target=self._refresh_forever, daemon=True).start()
+                self._refresher_pid = os.getpid()
+
+    @property
+    def snapshot(self):
+        """The current data, see `Snapshot`
+
+        The first use in a process starts the thread that refreshes the data,
+        so it should only be used while serving requests.
+
+        Returns:
+            :Snapshot
+
+        """
+        self.start_refresher_if_needed()
+        return self._snapshot
+
+    def peek_snapshot(self):
+        """The current data, without starting the refresher thread
+
+        For use while the app is being set up, which with gunicorn --preload
+        happens in the master process. Only the workers should poll for data.
+
+        Returns:
+            :Snapshot
+
+        """
+        return self._snapshot
+
+    @property
+    def last_load_time(self):
+        return self._snapshot.load_time
+
+    def cached(self, view, key, build, snapshot=None):
+        """Return a figure (or table, card) built from the current data
+
+        Results are cached by `view`, `key` and the snapshot's load time, so
+        each one is only built once per data load.
+
+        Args:
+            view (str): Name of the thing being built, e.g. 'counties_map'
+            key (str): State name or fips the thing is built for
+            build (callable): Takes a `Snapshot` and builds the thing
+            snapshot (Snapshot, optional): Build from this instead of the
+                current snapshot, e.g. one that is not published yet
+
+        Returns:
+            The return value of `build(snapshot)`
+
+        """
+        if snapshot is None:
+            snapshot = self.snapshot
+
+        def timed_build():
+            start = time.perf_counter()
+            value = build(snapshot)
+            metrics.observe('figure_build_seconds',
+                            time.perf_counter() - start,
+                            'Time to build figures on a cache miss',
+                            view=view)
+            return value
+
+        return self.figure_cache.get_or_build(
+            (view, key, snapshot.load_time), timed_build)
+
+    def state_counties(self, state, days_back=0, window=MAP_WINDOWS[0]):
+        """See `Snapshot.state_counties`"""
+        return self.snapshot.state_counties(state, days_back, window)
+
+    def state_counties_rows(self, state, days_back=0, window=MAP_WINDOWS[0]):
+        """See `Snapshot.state_counties_rows`"""
+        return self.snapshot.state_counties_rows(state, days_back, window)
 
     @property
     def counties_map_df(self):
@@ -59,8 +408,7 @@ class FreshData:
             :pandas.DataFrame
 
         """
-        self._refresh_if_needed()
-        return self._counties_map_df
+        return self.snapshot.counties_map_df
 
     @property
     def counties_df(self):
@@ -70,8 +418,7 @@ class FreshData:
             :pandas.DataFrame
 
         """
-        self._refresh_if_needed()
-        return self._counties_df
+        return self.snapshot.counties_df
 
     @property
     def states_df(self):
@@ -81,8 +428,7 @@ class FreshData:
             :pandas.DataFrame
 
         """
-        self._refresh_if_needed()
-        return self._states_df
+        return self.snapshot.states_df
 
     @property
     def states_map_df(self):
@@ -92,6 +438,14 @@ class FreshData:
             :pandas.DataFrame
 
         """
-        self._refresh_if_needed()
-        return self._states_map_df
+        return self.snapshot.states_map_df
 
+    @property
+    def trends_df(self):
+        """DataFrame with the latest trends for every state and county
+
+        Returns:
+            :pandas.DataFrame
+
+        """
+        return self.snapshot.trends_df
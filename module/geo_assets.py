@@ -0,0 +1,111 @@
+import gzip
+import hashlib
+import json
+import os
+import pickle
+
+import flask
+
+from constants import *
+
+GEO_URL_PREFIX = '/geo/'
+# Change this when the files change, so cached copies aren't used
+GEO_ASSETS_VERSION = 1
+
+
+class GeoAssets:
+    """County geojson for every state, served as static files
+
+    Each state's geojson is serialized and gzipped once. The file name
+    includes a hash of the content, so the files never change and browsers
+    can cache them forever. Maps reference them by URL instead of embedding
+    megabytes of geometry in every callback response.
+
+    Args:
+        states_geo (dict): Keys are state names (and 'USA'), values are
+            geojson dicts, from `FreshData._index_geo_by_state`
+
+    """
+
+    def __init__(self, states_geo):
+        self._urls = {}
+        self._files = {}
+        for state, geo in states_geo.items():
+            raw = json.dumps(geo, separators=(',', ':')).encode()
+            digest = hashlib.sha256(raw).hexdigest()[:16]
+            name = '{}.{}.json'.format(state.lower().replace(' ', '-'), digest)
+            self._urls[state] = GEO_URL_PREFIX + name
+            self._files[name] = (raw, gzip.compress(raw, 9), digest)
+
+    @classmethod
+    def cached(cls, directory, key, states_geo):
+        """Load `GeoAssets` saved by an earlier run, or make and save them
+
+        Serializing and gzipping every state's geojson is most of the work of
+        starting up, and the result only changes when the geojson does.
+
+        Args:
+            directory (str): Where the cached copy is kept
+            key (str): Changes whenever the geojson does, e.g. a hash of the
+                files it is loaded from
+            states_geo (callable): Takes no arguments and returns the
+                `states_geo` for `GeoAssets`. Only called if there is no
+                cached copy
+
+        Returns:
+            :GeoAssets
+
+        """
+        prefix = 'geo_assets.'
+        path = os.path.join(directory, '{}{}.{}.pkl'.format(
+            prefix, GEO_ASSETS_VERSION, key))
+        try:
+            with open(path, 'rb') as f:
+                assets = pickle.load(f)
+            print('reading "{}"'.format(path)) if LOG_LEVEL > 0 else None
+            return assets
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+        assets = cls(states_geo())
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(assets, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        # Remove copies made from older geojson
+        for f in os.listdir(directory):
+            old_path = os.path.join(directory, f)
+            if f.startswith(prefix) and f.endswith('.pkl') and old_path != path:
+                os.remove(old_path)
+        return assets
+
+    def url(self, state):
+        """URL of the county geojson for a state, or 'USA' for every county"""
+        return self._urls[state]
+
+    def response(self, name):
+        """Flask response for a geojson file, gzipped if the client allows it"""
+        if name not in self._files:
+            flask.abort(404)
+        raw, compressed, digest = self._files[name]
+
+        etag = '"{}"'.format(digest)
+        if etag in flask.request.headers.get('If-None-Match', ''):
+            response = flask.Response(status=304)
+        elif 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+            response = flask.Response(compressed, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = flask.Response(raw, mimetype='application/json')
+        response.headers['ETag'] = etag
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+def add_geo_endpoint(server, geo_assets):
+    """Serve `geo_assets` from the flask server at `GEO_URL_PREFIX`"""
+
+    @server.route(GEO_URL_PREFIX + '<name>')
+    def geo_file(name):
+        return geo_assets.response(name)
@@ -0,0 +1,186 @@
+"""Make simplified copies of the county geojson at a few levels of detail
+
+Borders shared by two counties are simplified once and used by both, so
+neighbouring counties still line up exactly (no gaps or overlaps) after
+simplifying. Coordinates are also rounded, which makes the json smaller.
+
+The levels are defined by `GEO_LEVELS` in "constants.py". Run from the
+covid-data directory to (re)write the files in covid-data/data:
+
+    python -m module.geo_simplify
+"""
+import json
+import time
+
+from constants import *
+
+FULL_GEO_FILE = 'data/geojson-counties-fips.json'
+
+
+def geo_file(level):
+    """Path of the county geojson for a level of detail"""
+    if level == 'full':
+        return FULL_GEO_FILE
+    return 'data/geojson-counties-fips-{}.json'.format(level)
+
+
+def geo_level_for_zoom(zoom):
+    """Least detailed level that still looks right at a mapbox zoom level"""
+    for level, (_, _, max_zoom) in GEO_LEVELS.items():
+        if zoom <= max_zoom:
+            return level
+    return 'full'
+
+
+def _rings(geometry):
+    if geometry['type'] == 'Polygon':
+        return [ring for ring in geometry['coordinates']]
+    return [ring for polygon in geometry['coordinates'] for ring in polygon]
+
+
+def _perpendicular_dist_sq(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return (p[0] - a[0]) ** 2 + (p[1] - a[1]) ** 2
+    t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)
+    t = max(0, min(1, t))
+    x, y = a[0] + t * dx, a[1] + t * dy
+    return (p[0] - x) ** 2 + (p[1] - y) ** 2
+
+
+def _douglas_peucker(points, tolerance):
+    """Simplify a line, always keeping the first and last points"""
+    if len(points) < 3:
+        return list(points)
+    tol_sq = tolerance ** 2
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_dist, max_i = 0, None
+        for i in range(first + 1, last):
+            d = _perpendicular_dist_sq(points[i], points[first], points[last])
+            if d > max_dist:
+                max_dist, max_i = d, i
+        if max_i is not None and max_dist > tol_sq:
+            keep[max_i] = True
+            stack.append((first, max_i))
+            stack.append((max_i, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def _junctions(rings):
+    """Points where a border between two counties starts or ends
+
+    A point is a junction if it has more than two different neighbouring
+    points over all of the rings it is in.
+    """
+    neighbours = {}
+    for ring in rings:
+        n = len(ring) - 1  # Rings are closed, the last point is the first
+        for i in range(n):
+            s = neighbours.setdefault(ring[i], set())
+            s.add(ring[i - 1] if i > 0 else ring[n - 1])
+            s.add(ring[i + 1])
+    return {p for p, s in neighbours.items() if len(s) > 2}
+
+
+def _simplify_ring(ring, junctions, tolerance, arc_cache):
+    points = ring[:-1]
+    cuts = [i for i, p in enumerate(points) if p in junctions]
+    if not cuts:
+        # An island, or a county that only borders one other county. Start
+        # at the smallest point so the other county's ring starts there too
+        cuts = [points.index(min(points))]
+    # Start the ring at a junction so every arc runs junction to junction
+    points = points[cuts[0]:] + points[:cuts[0]]
+    cuts = [c - cuts[0] for c in cuts] + [len(points)]
+    points = points + [points[0]]
+
+    simplified = []
+    for start, end in zip(cuts[:-1], cuts[1:]):
+        arc = tuple(points[start:end + 1])
+        # Simplify every shared arc in the same direction so both counties
+        # get exactly the same points
+        reverse = arc[::-1] < arc
+        key = arc[::-1] if reverse else arc
+        if key not in arc_cache:
+            arc_cache[key] = _douglas_peucker(key, tolerance)
+        s_arc = arc_cache[key][::-1] if reverse else arc_cache[key]
+        simplified.extend(s_arc[:-1])
+    simplified.append(simplified[0])
+
+    if len(simplified) < 4:
+        # Collapsed to a line, keep the unsimplified ring
+        return [list(p) for p in ring]
+    return [list(p) for p in simplified]
+
+
+def simplify_geo(geo, tolerance, decimals):
+    """Simplify and round the coordinates of a geojson FeatureCollection
+
+    Args:
+        geo (dict): Polygon and MultiPolygon features
+        tolerance (float): Douglas-Peucker tolerance in degrees
+        decimals (int): Number of decimal places to keep in the coordinates
+
+    Returns:
+        dict: A new geojson dict, `geo` is not modified
+
+    """
+    def quantize(ring):
+        return [(round(x, decimals), round(y, decimals)) for x, y in ring]
+
+    all_rings = [quantize(r) for f in geo['features']
+                 for r in _rings(f['geometry'])]
+    junctions = _junctions(all_rings)
+
+    arc_cache = {}
+    features = []
+    for f in geo['features']:
+        geometry = f['geometry']
+
+        def simplify_polygon(polygon):
+            return [_simplify_ring(quantize(r), junctions, tolerance, arc_cache)
+                    for r in polygon]
+
+        if geometry['type'] == 'Polygon':
+            coordinates = simplify_polygon(geometry['coordinates'])
+        else:
+            coordinates = [simplify_polygon(p) for p in geometry['coordinates']]
+        features.append(dict(f, geometry=dict(geometry, coordinates=coordinates)))
+    return dict(geo, features=features)
+
+
+def _n_points(geo):
+    return sum(len(r) for f in geo['features'] for r in _rings(f['geometry']))
+
+
+def write_geo_levels():
+    """Write a simplified geojson file for every level in `GEO_LEVELS`
+
+    Prints the number of points and the json size of each level compared to
+    the full resolution file.
+    """
+    with open(FULL_GEO_FILE) as f:
+        full_geo = json.load(f)
+    full_bytes = len(json.dumps(full_geo, separators=(',', ':')))
+    print('{:>8}: {:>7,} points, {:>10,} bytes'.format(
+        'full', _n_points(full_geo), full_bytes))
+
+    for level, (tolerance, decimals, max_zoom) in GEO_LEVELS.items():
+        start = time.perf_counter()
+        geo = simplify_geo(full_geo, tolerance, decimals)
+        secs = time.perf_counter() - start
+        text = json.dumps(geo, separators=(',', ':'))
+        with open(geo_file(level), 'w') as f:
+            f.write(text)
+        print('{:>8}: {:>7,} points, {:>10,} bytes ({:.0%} of full), '
+              'zoom <= {}, made in {:.1f}s'.format(
+                level, _n_points(geo), len(text), len(text) / full_bytes,
+                max_zoom, secs))
+
+
+if __name__ == '__main__':
+    write_geo_levels()
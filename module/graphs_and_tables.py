@@ -31,37 +31,26 @@ def _add_ave_and_rate_cols(cases_s, pop=None):
     return df.dropna()
 
 
-def trend_table(ser):
+def trend_table(trends):
     """Create an html table with summary statistics
 
     Args:
-        ser (pandas.Series): Index are dates, values new cases on that day
+        trends (pandas.Series): Row of `FreshData.trends_df` for one location
 
     Returns:
         dash_html_components: Table that shows new cases yesterday, 7-day trend, and 14-day trend
     """
-    df = _add_ave_and_rate_cols(ser)
-    yest = int(df['cases'][-1])  # Cases yesterday
-    yest_date_str = df.index[-1].strftime('%b %-d')
-    ave = df['cases_ave'][-1]  # Average cases as of yesterday
-    ave_week_ago = df['cases_ave'][-8]
-    ave_two_week_ago = df['cases_ave'][-15]
-
-    def percent_change_str(old, new):
-        if old == 0 and new > 0:
-            change = 100
-        elif old == 0 and new == 0:
-            change = 0
-        else:
-            change = int(round(((new - old) / old * 100), 0))
+    yest = int(trends['cases'])  # Cases yesterday
+    yest_date_str = trends['date'].strftime('%b %-d')
 
+    def percent_change_str(change):
         if change > 0:
             return '+{}%'.format(change)
         else:
             return '{}%'.format(change)
 
-    week_change = percent_change_str(ave_week_ago, ave)
-    two_week_change = percent_change_str(ave_two_week_ago, ave)
+    week_change = percent_change_str(trends['week_change'])
+    two_week_change = percent_change_str(trends['two_week_change'])
 
     style = {'textAlign': 'center'}
     table_header = [
@@ -0,0 +1,101 @@
+"""Stand-in for a google cloud storage bucket, backed by a local directory
+
+Implements just the parts of `google.cloud.storage.Bucket` and `Blob` that
+`GCSStorage` uses, so the google cloud code path can be run and benchmarked
+without network access or credentials:
+
+    DataHandler.use_storage(
+        GCSStorage(bucket=LocalBucket('/tmp/bucket', latency=0.2)))
+"""
+import os
+import shutil
+import time
+
+
+class LocalBucket:
+    """A directory that behaves like a bucket
+
+    Args:
+        directory (str): Where the blobs are kept, created if needed
+        latency (float, optional): Seconds every transfer sleeps for, to mimic
+            a round trip to cloud storage
+
+    """
+
+    def __init__(self, directory, latency=0):
+        self.directory = directory
+        self.latency = latency
+        os.makedirs(directory, exist_ok=True)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix=''):
+        """Blobs whose names start with `prefix`"""
+        time.sleep(self.latency)
+        blobs = []
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                name = os.path.relpath(os.path.join(root, f), self.directory)
+                name = name.replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith('.tmp'):
+                    blobs.append(LocalBlob(self, name))
+        return sorted(blobs, key=lambda b: b.name)
+
+    def get_blob(self, name):
+        """The blob called `name`, or `None` if it doesn't exist"""
+        time.sleep(self.latency)
+        blob = LocalBlob(self, name)
+        return blob if os.path.exists(blob.path) else None
+
+
+class LocalBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.directory, *name.split('/'))
+
+    @property
+    def generation(self):
+        # Changes every time the blob is written, like a real generation
+        return os.stat(self.path).st_mtime_ns
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def upload_from_string(self, data):
+        time.sleep(self.bucket.latency)
+        if isinstance(data, str):
+            data = data.encode()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def upload_from_file(self, file):
+        self.upload_from_string(file.read())
+
+    def upload_from_filename(self, filename):
+        with open(filename, 'rb') as f:
+            self.upload_from_file(f)
+
+    def download_as_string(self, start=None, end=None):
+        """The blob's bytes, `end` is inclusive like the real client's"""
+        time.sleep(self.bucket.latency)
+        with open(self.path, 'rb') as f:
+            if start:
+                f.seek(start)
+            if end is None:
+                return f.read()
+            return f.read(end + 1 - (start or 0))
+
+    def download_to_filename(self, filename):
+        time.sleep(self.bucket.latency)
+        shutil.copyfile(self.path, filename)
+
+    def delete(self):
+        time.sleep(self.bucket.latency)
+        os.remove(self.path)
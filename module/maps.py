@@ -1,5 +1,7 @@
+from functools import lru_cache
+from threading import Lock
+
 import plotly.graph_objects as go
-from copy import deepcopy
 
 MAP_WIDTH = 625
 Z_MAX = 50
@@ -7,9 +9,92 @@ COLORBAR = dict(x=1, title=dict(text='Average<br>Daily<br>Cases<br>per 100k',
                                 font=dict(size=14, color='#A10C0C')))
 
 
+# Figure dicts built once per process, see `_from_template`
+_templates = {}
+_templates_lock = Lock()
+
+
+@lru_cache(maxsize=None)
+def _mapbox_token():
+    # you will need your own mapbox token,
+    with open("./.mapbox_token") as f:
+        return f.read()
+
+
+def _from_template(key, build, trace_updates, layout_updates=None):
+    """Return a figure dict made by patching a prebuilt figure
+
+    The first time `key` is seen, `build()` is called to make a figure, which
+    is kept as a dict. Later calls only swap in the data arrays (and any
+    other values that change), so the colorbar, layout, mapbox settings etc.
+    are not validated again. The result serializes to the same json as the
+    figure `build()` would make with the same data.
+
+    Args:
+        key (tuple): What the template is for, e.g. ('counties', state)
+        build (callable): Takes no arguments, returns a go.Figure
+        trace_updates (dict): Values to set on the (only) trace
+        layout_updates (dict, optional): Values to set on the layout
+
+    Returns:
+        dict: Plotly figure dict, usable anywhere a go.Figure is
+
+    """
+    template = _templates.get(key)
+    if template is None:
+        with _templates_lock:
+            template = _templates.get(key)
+            if template is None:
+                template = build().to_plotly_json()
+                _templates[key] = template
+    fig = dict(template)
+    fig['data'] = [dict(template['data'][0], **trace_updates)]
+    if layout_updates:
+        fig['layout'] = dict(template['layout'], **layout_updates)
+    return fig
+
+
+def _annotation(date):
+    return dict(
+        x=0.0,
+        y=0.0,
+        xref='paper',
+        yref='paper',
+        text='As of {}'.format(date.strftime('%b %-d')),
+        showarrow=False
+    )
+
+
+@lru_cache(maxsize=64)
+def _annotation_json(date):
+    """`_annotation` as plotly serializes it, with the keys in its order"""
+    return go.layout.Annotation(_annotation(date)).to_plotly_json()
+
+
 def states_map(states_map_df, date):
     """Create a Choropleth plot of the US states
 
+    Args:
+        states_map_df (pandas.DataFrame): Index are names of states, columns must include 'abbr', 'ave_rate', and 'text'
+        date (datetime): Date that states_map_df was created
+
+    Returns:
+        dict: Plotly figure dict, see `_from_template`
+
+    """
+    return _from_template(
+        ('states',),
+        lambda: _build_states_map(states_map_df, date),
+        dict(locations=states_map_df['abbr'].to_numpy(),
+             z=states_map_df['ave_rate'].to_numpy(dtype=float),
+             customdata=states_map_df.index.to_list(),
+             text=states_map_df['text'].to_numpy()),
+        dict(annotations=[_annotation_json(date)]))
+
+
+def _build_states_map(states_map_df, date):
+    """Create a Choropleth plot of the US states
+
     Args:
         states_map_df (pandas.DataFrame): Index are names of states, columns must include 'abbr', 'ave_rate', and 'text'
         date (datetime): Date that states_map_df was created
@@ -36,14 +121,7 @@ def states_map(states_map_df, date):
         geo_scope='usa',
         width=MAP_WIDTH,
         height=310,
-        annotations=[dict(
-            x=0.0,
-            y=0.0,
-            xref='paper',
-            yref='paper',
-            text='As of {}'.format(date.strftime('%b %-d')),
-            showarrow=False
-        )]
+        annotations=[_annotation(date)]
     )
     return fig
 
@@ -52,24 +130,47 @@ def counties_map(counties_map_df, counties_geo, states_meta_df, state):
     """County-level map that shows the average cases per day rate
 
     Args:
-        counties_map_df (pandas.DataFrame): from FreshData
-        counties_geo (dict): from FreshData
+        counties_map_df (pandas.DataFrame): Rows for the counties in `state`,
+            from `FreshData.state_counties_rows`
+        counties_geo (dict or str): Geojson for the counties in `state`, from
+            `FreshData.state_counties`, or the URL of it from
+            `FreshData.geo_assets`
         states_meta_df (pandas.DataFrame): from FreshData
         state (str): US state to show a map of
 
     Returns:
-        plotly.graph_objects.Figure:
+        dict: Plotly figure dict, see `_from_template`
 
     """
     df = counties_map_df
+    return _from_template(
+        ('counties', state),
+        lambda: _build_counties_map(df, counties_geo, states_meta_df, state),
+        dict(geojson=counties_geo,
+             locations=df['fips'].to_numpy(),
+             z=df['ave_rate'].to_numpy(),
+             customdata=df['state'].to_numpy(),
+             text=df['text'].to_numpy()))
+
 
-    geo = deepcopy(counties_geo)
-    if state != 'USA':
-        df = df[df['state'] == state]
-        state_num = states_meta_df.loc[state, 'fips']
-        l = [f for f in counties_geo['features'] if
-             f['properties']['STATE'] == state_num]
-        geo['features'] = l
+def _build_counties_map(counties_map_df, counties_geo, states_meta_df, state):
+    """County-level map that shows the average cases per day rate
+
+    Args:
+        counties_map_df (pandas.DataFrame): Rows for the counties in `state`,
+            from `FreshData.state_counties_rows`
+        counties_geo (dict or str): Geojson for the counties in `state`, from
+            `FreshData.state_counties`, or the URL of it from
+            `FreshData.geo_assets`
+        states_meta_df (pandas.DataFrame): from FreshData
+        state (str): US state to show a map of
+
+    Returns:
+        plotly.graph_objects.Figure:
+
+    """
+    df = counties_map_df
+    geo = counties_geo
 
     fig = go.Figure(
         go.Choroplethmapbox(
@@ -88,8 +189,7 @@ def counties_map(counties_map_df, counties_geo, states_meta_df, state):
     )
 
     fig.update_layout(
-        # you will need your own mapbox token,
-        mapbox_accesstoken=open("./.mapbox_token").read(),
+        mapbox_accesstoken=_mapbox_token(),
         mapbox_style='light',
         width=MAP_WIDTH,
         height=414,
@@ -0,0 +1,147 @@
+import time
+from threading import Lock
+
+import flask
+
+
+class Metrics:
+    """Thread-safe counters exposed in the Prometheus text format
+
+    Summaries keep a count, sum and max of observed values per set of
+    labels. Gauges keep the last value set. Both are cheap enough to update on
+    every request.
+    """
+
+    def __init__(self):
+        self._summaries = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, help_text='', **labels):
+        """Add one observation to the summary `name`"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._help.setdefault(name, ('summary', help_text))
+            s = self._summaries.setdefault(key, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += value
+            s[2] = max(s[2], value)
+
+    def set_gauge(self, name, value, help_text='', **labels):
+        with self._lock:
+            self._help.setdefault(name, ('gauge', help_text))
+            self._gauges[self._key(name, labels)] = value
+
+    @staticmethod
+    def _labels_str(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        escaped = ('{}="{}"'.format(
+            k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in labels)
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format
+
+        Returns:
+            str:
+
+        """
+        with self._lock:
+            summaries = {k: list(v) for k, v in self._summaries.items()}
+            gauges = dict(self._gauges)
+            help_items = dict(self._help)
+
+        lines = []
+        for name, (kind, help_text) in sorted(help_items.items()):
+            if help_text:
+                lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'summary':
+                for (n, labels), (count, total, max_val) in sorted(summaries.items()):
+                    if n != name:
+                        continue
+                    lines.append('{}_count{} {}'.format(
+                        name, self._labels_str(labels), count))
+                    lines.append('{}_sum{} {}'.format(
+                        name, self._labels_str(labels), total))
+                    lines.append('{}_max{} {}'.format(
+                        name, self._labels_str(labels), max_val))
+            else:
+                for (n, labels), value in sorted(gauges.items()):
+                    if n == name:
+                        lines.append('{}{} {}'.format(
+                            name, self._labels_str(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+# One set of metrics per process
+metrics = Metrics()
+
+
+def _callback_input_label(body):
+    """Short label for the input that triggered a Dash callback
+
+    Uses the state or fips for clicks on a map, and the value itself for
+    everything else.
+    """
+    changed = body.get('changedPropIds') or []
+    for i in body.get('inputs', []):
+        if '{}.{}'.format(i.get('id'), i.get('property')) not in changed:
+            continue
+        value = i.get('value')
+        if isinstance(value, dict):
+            point = (value.get('points') or [{}])[0]
+            return point.get('location') or point.get('customdata') or ''
+        return '' if value is None else str(value)
+    return ''
+
+
+def add_metrics_endpoint(server, fd):
+    """Record per-callback metrics and serve them at /metrics
+
+    For every Dash callback request this records the wall time (including
+    Dash serializing the response) and the size of the response body, by
+    callback output and input value.
+
+    Args:
+        server (flask.Flask): `app.server`
+        fd (module.fresh_data.FreshData): to report the figure cache stats
+
+    """
+
+    @server.before_request
+    def start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        if flask.request.path.endswith('/_dash-update-component'):
+            body = flask.request.get_json(silent=True) or {}
+            # Not `value`, which is the name of `observe`'s own argument
+            labels = dict(callback=body.get('output', ''),
+                          input=_callback_input_label(body))
+            metrics.observe(
+                'dash_callback_seconds',
+                time.perf_counter() - flask.g.metrics_start,
+                'Wall time of Dash callback requests', **labels)
+            metrics.observe(
+                'dash_callback_response_bytes',
+                response.calculate_content_length() or 0,
+                'Size of Dash callback responses', **labels)
+        return response
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        for k, v in fd.figure_cache.stats().items():
+            metrics.set_gauge('figure_cache_{}'.format(k), v,
+                              'Figure cache {}'.format(k))
+        return flask.Response(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
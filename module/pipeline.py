@@ -0,0 +1,221 @@
+"""Run a job as stages whose results are checkpointed to disk
+
+Each stage declares the values it reads and the values it makes. A stage's
+checkpoint is keyed by a hash of its code and the keys of its inputs, and
+each output's key is derived from the checkpoint key. So once the external
+inputs (e.g. the hashes of the downloaded files) are known, every key in the
+pipeline is known without looking at any data. A rerun with the same inputs
+and code loads the checkpoints, and after a change only the stages
+downstream of it run again.
+"""
+import hashlib
+import inspect
+import os
+import pickle
+import resource
+import time
+from contextlib import contextmanager
+
+from constants import *
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB (Linux reports KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _hash(*parts):
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def _value_repr(value):
+    # Sets are in a different order in each run, string hashes are salted
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(value))
+    return repr(value)
+
+
+def _source(func):
+    try:
+        return inspect.getsource(func)
+    except OSError:
+        # No source file, e.g. defined in an interactive session
+        code = func.__code__
+        return repr((code.co_code, code.co_consts, code.co_names))
+
+
+class StageTimer:
+    """Time the stages of a job and print a breakdown at the end
+
+    Example:
+        timer = StageTimer()
+        with timer.stage('download'):
+            ...
+        timer.report()
+
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.peak_rss_mb = {}
+        self.cached = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (
+                    self.timings.get(name, 0) + time.perf_counter() - start)
+            # Peak for the whole process so far, not just this stage
+            self.peak_rss_mb[name] = _peak_rss_mb()
+
+    def report(self):
+        if LOG_LEVEL > 0:
+            total = sum(self.timings.values())
+            for name, secs in self.timings.items():
+                cached = {True: 'checkpoint', False: 'ran'}.get(
+                    self.cached.get(name), '')
+                print('{:>14}: {:7.3f}s {:>10}, peak RSS so far {:.0f} MB'.format(
+                    name, secs, cached, self.peak_rss_mb[name]))
+            print('{:>14}: {:7.3f}s {:>10}, peak RSS {:.0f} MB'.format(
+                'total', total, '', _peak_rss_mb()))
+            if self.cached:
+                print('{} of {} stages loaded from checkpoints'.format(
+                    sum(self.cached.values()), len(self.cached)))
+
+
+class Stage:
+    """One step of a `Pipeline`
+
+    Args:
+        name (str): Also the prefix of the stage's checkpoint files
+        func (callable): Called with the inputs in order. Returns the outputs,
+            as a tuple if there is more than one. Must not modify its inputs
+        inputs (list): Names of the values `func` takes
+        outputs (list): Names of the values `func` returns
+        uses (list, optional): Functions that `func` calls. Their code is part
+            of the checkpoint key along with `func`'s, so changing any of them
+            reruns the stage
+        constants (dict, optional): Module level values that `func` or `uses`
+            read, by name. Changing any of them also reruns the stage
+
+    """
+
+    def __init__(self, name, func, inputs, outputs, uses=(), constants=None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.uses = uses
+        self.constants = constants or {}
+
+    def code_version(self):
+        """Hash of the source code of `func` and `uses`, and of `constants`"""
+        return _hash(*[_source(f) for f in [self.func, *self.uses]],
+                     *['{}={}'.format(k, _value_repr(v))
+                       for k, v in sorted(self.constants.items())])
+
+
+class Pipeline:
+    """Run `Stage`s, loading their outputs from checkpoints when possible
+
+    Values are loaded lazily, so a checkpoint is only read if a stage that
+    has to run, or the caller, actually uses one of its outputs.
+
+    Args:
+        checkpoint_dir (str): Where the checkpoints are kept
+        timer (StageTimer, optional): Stages are timed and their cache hits
+            recorded in this
+
+    """
+
+    def __init__(self, checkpoint_dir, timer=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.timer = timer or StageTimer()
+        self._keys = {}
+        self._loaders = {}
+        self._values = {}
+
+    def add_input(self, name, key, load):
+        """Add a value that comes from outside of the pipeline
+
+        Args:
+            name (str):
+            key (str): Changes whenever the value does, e.g. a file's hash
+            load (callable): Takes no arguments and returns the value. Only
+                called if the value is used
+
+        """
+        self._keys[name] = _hash(name, key)
+        self._loaders[name] = load
+        self._values.pop(name, None)
+
+    def get(self, name):
+        """The value called `name`, loading or computing it if needed"""
+        if name not in self._values:
+            self._values[name] = self._loaders[name]()
+        return self._values[name]
+
+    def _checkpoint_path(self, stage, key):
+        return os.path.join(self.checkpoint_dir,
+                            '{}.{}.pkl'.format(stage.name, key[:24]))
+
+    def _remove_old_checkpoints(self, stage, keep):
+        for f in os.listdir(self.checkpoint_dir):
+            path = os.path.join(self.checkpoint_dir, f)
+            if f.startswith(stage.name + '.') and path != keep:
+                os.remove(path)
+
+    def run(self, *stages):
+        """Run the stages in order, skipping any that have a checkpoint"""
+        for stage in stages:
+            key = _hash(stage.name, stage.code_version(),
+                        *[self._keys[i] for i in stage.inputs])
+            path = self._checkpoint_path(stage, key)
+            cached = os.path.exists(path)
+            self.timer.cached[stage.name] = cached
+
+            if cached:
+                print('"{}" is unchanged, using its checkpoint'.format(
+                    stage.name)) if LOG_LEVEL > 0 else None
+                outputs = self._lazy_checkpoint(stage, path)
+                # Still listed in the report if nothing loads the checkpoint
+                self.timer.timings.setdefault(stage.name, 0)
+                self.timer.peak_rss_mb.setdefault(stage.name, _peak_rss_mb())
+            else:
+                with self.timer.stage(stage.name):
+                    result = stage.func(*[self.get(i) for i in stage.inputs])
+                    if len(stage.outputs) == 1:
+                        result = (result,)
+                    self._save_checkpoint(stage, path, result)
+                outputs = {n: (lambda v=v: v)
+                           for n, v in zip(stage.outputs, result)}
+
+            for name in stage.outputs:
+                self._keys[name] = _hash(key, name)
+                self._loaders[name] = outputs[name]
+                self._values.pop(name, None)
+
+    def _save_checkpoint(self, stage, path, result):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._remove_old_checkpoints(stage, path)
+
+    def _lazy_checkpoint(self, stage, path):
+        """Loaders for each output of a stage, that read the file at most once"""
+        loaded = []
+
+        def load_all():
+            if not loaded:
+                with self.timer.stage(stage.name):
+                    with open(path, 'rb') as f:
+                        loaded.append(pickle.load(f))
+            return loaded[0]
+
+        return {name: (lambda i=i: load_all()[i])
+                for i, name in enumerate(stage.outputs)}
@@ -0,0 +1,130 @@
+import gzip
+import json
+
+import flask
+from plotly.utils import PlotlyJSONEncoder
+
+# Matches any trigger or input value, see `PrerenderedCallbacks.set_responses`
+ANY = object()
+
+
+def dash_response_json(output, value):
+    """Serialize a callback's return value the way Dash does
+
+    This follows the response format of the pinned version of Dash (see
+    "requirements.txt"): {"response": {id: {property: value}}, "multi": true}
+
+    Args:
+        output (str): Dash output id, e.g. 'counties-map.figure', or
+            '..usa-card.children...states-map.figure..' for multiple outputs
+        value: What the callback returns
+
+    Returns:
+        bytes:
+
+    """
+    if output.startswith('..'):
+        specs = output[2:-2].split('...')
+        values = value
+    else:
+        specs = [output]
+        values = [value]
+
+    response = {}
+    for spec, v in zip(specs, values):
+        component_id, prop = spec.rsplit('.', 1)
+        response.setdefault(component_id, {})[prop] = v
+    return json.dumps(dict(response=response, multi=True),
+                      cls=PlotlyJSONEncoder).encode()
+
+
+class PrerenderedCallbacks:
+    """Dash callback responses that are serialized ahead of time
+
+    Dash runs Plotly's json encoder on every callback response, which for
+    big figures costs more than building them. Responses set here are
+    encoded (and gzipped) once, and then returned straight from a flask
+    `before_request` hook, so Dash never sees the request.
+
+    Args:
+        defaults (dict, optional): Input prop ids (e.g. 'date-slider.value')
+            to the value the prerendered responses were made for. Requests
+            where any of these inputs has another value go to Dash
+
+    """
+
+    def __init__(self, defaults=None):
+        self._responses = {}
+        self._defaults = {k: json.dumps(v) for k, v in (defaults or {}).items()}
+
+    def set_responses(self, entries):
+        """Replace all of the prerendered responses
+
+        Args:
+            entries (iterable): Tuples of (output, trigger, value, response).
+                `output` is the Dash output id, `trigger` is the prop id of the
+                input that changed (e.g. 'state-dropdown.value'), `value` is
+                the value of that input, and `response` is what the callback
+                would return. `trigger` and `value` can be `ANY`.
+
+        """
+        self.set_encoded_responses(
+            (output, trigger, value, dash_response_json(output, response))
+            for output, trigger, value, response in entries)
+
+    def set_encoded_responses(self, entries):
+        """Same as `set_responses`, but responses are already serialized
+
+        Args:
+            entries (iterable): Tuples of (output, trigger, value, raw) where
+                `raw` is from `dash_response_json`
+
+        """
+        responses = {}
+        for output, trigger, value, raw in entries:
+            key = (output, trigger, value if value is ANY else json.dumps(value))
+            responses[key] = (raw, gzip.compress(raw, 6))
+        # Swap in all of the new responses at once
+        self._responses = responses
+
+    def _lookup(self, body):
+        output = body.get('output')
+        changed = body.get('changedPropIds') or []
+        trigger = changed[0] if len(changed) == 1 else None
+        value = None
+        for i in body.get('inputs', []):
+            prop_id = '{}.{}'.format(i.get('id'), i.get('property'))
+            input_value = json.dumps(i.get('value'))
+            if self._defaults.get(prop_id, input_value) != input_value:
+                return None
+            if prop_id == trigger:
+                value = input_value
+
+        responses = self._responses
+        for key in [(output, trigger, value), (output, trigger, ANY),
+                    (output, ANY, ANY)]:
+            if key in responses:
+                return responses[key]
+        return None
+
+    def add_to_server(self, server):
+        """Answer matching Dash callback requests on `server`"""
+
+        @server.before_request
+        def prerendered_response():
+            request = flask.request
+            if not request.path.endswith('/_dash-update-component'):
+                return None
+            found = self._lookup(request.get_json(silent=True) or {})
+            if found is None:
+                return None
+
+            raw, compressed = found
+            if 'gzip' in request.headers.get('Accept-Encoding', ''):
+                response = flask.Response(compressed,
+                                          mimetype='application/json')
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response = flask.Response(raw, mimetype='application/json')
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
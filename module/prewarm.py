@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from constants import *
+from module.metrics import metrics
+
+# The job being run by `run_in_pool`. Forked pool processes inherit it, so the
+# snapshot never has to be pickled
+_job = None
+
+
+def _run_task(i):
+    snapshot, tasks, build = _job
+    return build(snapshot, tasks[i])
+
+
+def _n_processes():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def run_in_pool(snapshot, tasks, build):
+    """Run `build(snapshot, task)` for every task, spread over all cores
+
+    Uses forked processes, so `snapshot` and `build` are shared with them
+    rather than pickled. Only the results are sent back, so they need to be
+    picklable.
+
+    Only a process with no other threads forks, i.e. at startup (once, in the
+    gunicorn master with --preload). A fork while another thread holds a lock
+    (e.g. the figure cache's) leaves the lock held forever in the child, so
+    once the refresher or request threads are running, e.g. for a refresh,
+    everything runs in this process instead. So does everything with one
+    core.
+
+    Args:
+        snapshot (module.fresh_data.Snapshot): Passed to every call of `build`
+        tasks (list): Passed one at a time to `build`
+        build (callable): Takes `snapshot` and a task
+
+    Returns:
+        list: The results, in the same order as `tasks`
+
+    """
+    global _job
+    start = time.perf_counter()
+    processes = min(_n_processes(), len(tasks))
+    if threading.active_count() > 1:
+        processes = 1
+    _job = (snapshot, tasks, build)
+    try:
+        if processes > 1:
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                results = pool.map(_run_task, range(len(tasks)))
+        else:
+            results = [_run_task(i) for i in range(len(tasks))]
+    finally:
+        _job = None
+
+    secs = time.perf_counter() - start
+    metrics.observe('prewarm_seconds', secs,
+                    'Time to prewarm every view for a new snapshot')
+    print('Prewarmed {} views with {} processes in {:.1f}s'.format(
+        len(tasks), processes, secs)) if LOG_LEVEL > 0 else None
+    return results
@@ -0,0 +1,660 @@
+"""Storage backends for `DataHandler`
+
+Every backend stores named objects (e.g. 'manifest.json' or
+'bundles/1a2b.zip') and has the same methods, so the ETL and the app don't
+care where the data lives:
+
+    LocalStorage   Files in a directory, covid-data/data by default
+    GCSStorage     A google cloud storage bucket
+    HTTPStorage    An object store with a plain HTTP interface, see
+                   `start_server`
+    MemoryStorage  A dict in this process, for tests and benchmarks
+
+`storage_from_url` makes one from a string, and `DataHandler` uses the
+`COVID_DATA_STORAGE` environment variable if it is set, so backends can be
+switched without editing "constants.py":
+
+    COVID_DATA_STORAGE=local:data
+    COVID_DATA_STORAGE=gcs:covid-283120.appspot.com
+    COVID_DATA_STORAGE=http://127.0.0.1:8081
+    COVID_DATA_STORAGE=memory:
+
+Network backends reuse their connections and retry transient failures.
+Reads can ask for a byte range, and `Storage.open` gives a seekable file
+made of range reads, so e.g. the ETL reads two files out of the last
+bundle's zip without downloading all of it.
+
+Run a local HTTP object store, backed by a directory, with:
+
+    python -m module.storage --dir /tmp/covid-store --port 8081 --latency 0.05
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from constants import *
+
+STORAGE_ENV_VAR = 'COVID_DATA_STORAGE'
+
+
+class TransientStorageError(OSError):
+    """A failure that is likely to go away if the request is retried"""
+
+
+def with_retries(func, retry_on, retries=STORAGE_RETRIES,
+                 backoff=STORAGE_RETRY_SECS):
+    """Call `func`, retrying with exponential backoff if it fails
+
+    Args:
+        func (callable): Takes no arguments
+        retry_on (tuple): Exception types worth retrying
+        retries (int, optional): Times to call `func` again after it fails
+        backoff (float, optional): Seconds to wait before the first retry
+
+    Returns:
+        What `func` returns
+
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except retry_on as e:
+            if attempt == retries:
+                raise
+            print('Storage request failed ({}), retrying'.format(
+                e)) if LOG_LEVEL > 0 else None
+            time.sleep(backoff * 2 ** attempt)
+
+
+class Storage:
+    """Interface of the storage backends
+
+    Missing objects raise `FileNotFoundError` from every backend. Ranges are
+    like Python slices, `read(name, 10, 20)` is bytes 10 to 19.
+    """
+    # Set when objects are plain files that can be used in place
+    local_dir = None
+
+    def read(self, name, start=None, end=None):
+        """Bytes of an object, or of the range `start` to `end` of it"""
+        raise NotImplementedError
+
+    def write(self, name, data):
+        """Create or replace an object, readers see the old or new bytes"""
+        raise NotImplementedError
+
+    def write_file(self, name, path):
+        with open(path, 'rb') as f:
+            self.write(name, f.read())
+
+    def download(self, name, path):
+        """Copy an object to a local file"""
+        data = self.read(name)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def version(self, name):
+        """A string that changes whenever the object does"""
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        """Names of the objects that start with `prefix`"""
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def size(self, name):
+        """Length of an object in bytes"""
+        raise NotImplementedError
+
+    def open(self, name):
+        """A seekable binary file to read an object with
+
+        Only the parts that are read are fetched, `STORAGE_READ_BYTES` at a
+        time.
+        """
+        return io.BufferedReader(StorageFile(self, name),
+                                 buffer_size=STORAGE_READ_BYTES)
+
+    def local_path(self, name):
+        """Path of the object's file if it can be read in place, or `None`"""
+        if self.local_dir is None:
+            return None
+        return os.path.join(self.local_dir, *name.split('/'))
+
+
+class StorageFile(io.RawIOBase):
+    """Read only file whose reads are range reads of an object
+
+    Args:
+        storage (Storage):
+        name (str): Name of the object
+
+    """
+
+    def __init__(self, storage, name):
+        self._storage = storage
+        self.name = name
+        self._size = storage.size(name)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, b):
+        end = min(self._pos + len(b), self._size)
+        if end <= self._pos:
+            return 0
+        data = self._storage.read(self.name, self._pos, end)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class LocalStorage(Storage):
+    """Objects are files under `directory`
+
+    Args:
+        directory (str, optional): Defaults to covid-data/data
+
+    """
+
+    def __init__(self, directory='data'):
+        self.local_dir = directory
+
+    def __repr__(self):
+        return 'LocalStorage({!r})'.format(self.local_dir)
+
+    def read(self, name, start=None, end=None):
+        with open(self.local_path(name), 'rb') as f:
+            if start:
+                f.seek(start)
+            if end is None:
+                return f.read()
+            return f.read(end - (start or 0))
+
+    def _replace(self, name, write_tmp):
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        write_tmp(tmp_path)
+        # Renamed in one step, readers never see half a file
+        os.replace(tmp_path, path)
+
+    def write(self, name, data):
+        def write_tmp(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        self._replace(name, write_tmp)
+
+    def write_file(self, name, path):
+        self._replace(name, lambda tmp_path: shutil.copyfile(path, tmp_path))
+
+    def download(self, name, path):
+        shutil.copyfile(self.local_path(name), path)
+
+    def version(self, name):
+        return str(os.stat(self.local_path(name)).st_mtime_ns)
+
+    def size(self, name):
+        return os.path.getsize(self.local_path(name))
+
+    def open(self, name):
+        return open(self.local_path(name), 'rb')
+
+    def list(self, prefix=''):
+        names = []
+        for root, _, files in os.walk(self.local_dir):
+            for f in files:
+                name = os.path.relpath(os.path.join(root, f), self.local_dir)
+                name = name.replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith('.tmp'):
+                    names.append(name)
+        return sorted(names)
+
+    def delete(self, name):
+        os.remove(self.local_path(name))
+
+
+class MemoryStorage(Storage):
+    """Objects are kept in a dict in this process
+
+    Args:
+        latency (float, optional): Seconds every request sleeps for, to mimic
+            a round trip to a real object store
+
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self._objects = {}
+        self._versions = 0
+        self._lock = Lock()
+
+    def __repr__(self):
+        return 'MemoryStorage(latency={})'.format(self.latency)
+
+    def _get(self, name):
+        time.sleep(self.latency)
+        try:
+            return self._objects[name]
+        except KeyError:
+            raise FileNotFoundError(name) from None
+
+    def read(self, name, start=None, end=None):
+        return self._get(name)[0][start:end]
+
+    def write(self, name, data):
+        time.sleep(self.latency)
+        with self._lock:
+            self._versions += 1
+            self._objects[name] = (bytes(data), str(self._versions))
+
+    def version(self, name):
+        return self._get(name)[1]
+
+    def size(self, name):
+        return len(self._get(name)[0])
+
+    def list(self, prefix=''):
+        time.sleep(self.latency)
+        return sorted(n for n in list(self._objects) if n.startswith(prefix))
+
+    def delete(self, name):
+        time.sleep(self.latency)
+        with self._lock:
+            if self._objects.pop(name, None) is None:
+                raise FileNotFoundError(name)
+
+
+def _is_not_found(e):
+    return isinstance(e, FileNotFoundError) or getattr(e, 'code', None) == 404
+
+
+class GCSStorage(Storage):
+    """Objects are blobs in a google cloud storage bucket
+
+    One client is shared by every thread in a process, see `_bucket`.
+
+    Args:
+        bucket_name (str, optional): Defaults to `BUCKET`
+        bucket (optional): Use this instead of a real bucket, e.g. a
+            `module.local_bucket.LocalBucket`
+
+    """
+
+    def __init__(self, bucket_name=BUCKET, bucket=None):
+        self.bucket_name = bucket_name
+        self._bucket_override = bucket
+        self._client = None
+        self._client_pid = None
+        self._client_lock = Lock()
+        self._transient = None
+
+    def __repr__(self):
+        return 'GCSStorage({!r})'.format(self.bucket_name)
+
+    def _bucket(self):
+        """The bucket, through a client shared by every thread
+
+        Creating a client means fetching credentials and opening new https
+        connections, so it is only done once per process. The connection pool
+        is sized so that each of the `IO_THREADS` threads in
+        `run_concurrently` can keep a connection open.
+        """
+        if self._bucket_override is not None:
+            return self._bucket_override
+        # Connections can't be shared across a fork, so each gunicorn worker
+        # makes its own client
+        if self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client_pid != os.getpid():
+                    # Only needed when using google cloud
+                    from google.cloud import storage
+                    from requests.adapters import HTTPAdapter
+                    client = storage.Client()
+                    adapter = HTTPAdapter(pool_connections=IO_THREADS,
+                                          pool_maxsize=IO_THREADS)
+                    client._http.mount('https://', adapter)
+                    self._client = client
+                    self._client_pid = os.getpid()
+        return self._client.bucket(self.bucket_name)
+
+    def _transient_errors(self):
+        if self._transient is None:
+            transient = [ConnectionError, TimeoutError]
+            try:
+                from google.api_core import exceptions
+                import requests.exceptions
+                transient += [exceptions.TooManyRequests,
+                              exceptions.InternalServerError,
+                              exceptions.BadGateway,
+                              exceptions.ServiceUnavailable,
+                              exceptions.GatewayTimeout,
+                              requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout]
+            except ImportError:
+                pass
+            self._transient = tuple(transient)
+        return self._transient
+
+    def _call(self, name, func):
+        try:
+            return with_retries(func, self._transient_errors())
+        except Exception as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(name) from e
+            raise
+
+    def read(self, name, start=None, end=None):
+        blob = self._bucket().blob(name)
+        # The google client's end is inclusive
+        return self._call(name, lambda: blob.download_as_string(
+            start=start, end=None if end is None else end - 1))
+
+    def write(self, name, data):
+        blob = self._bucket().blob(name)
+        self._call(name, lambda: blob.upload_from_string(data))
+
+    def write_file(self, name, path):
+        blob = self._bucket().blob(name)
+        self._call(name, lambda: blob.upload_from_filename(path))
+
+    def download(self, name, path):
+        blob = self._bucket().blob(name)
+        self._call(name, lambda: blob.download_to_filename(path))
+
+    def _get_blob(self, name):
+        blob = self._call(name, lambda: self._bucket().get_blob(name))
+        if blob is None:
+            raise FileNotFoundError(name)
+        return blob
+
+    def version(self, name):
+        return str(self._get_blob(name).generation)
+
+    def size(self, name):
+        return self._get_blob(name).size
+
+    def list(self, prefix=''):
+        return self._call(prefix, lambda: sorted(
+            b.name for b in self._bucket().list_blobs(prefix=prefix)))
+
+    def delete(self, name):
+        blob = self._bucket().blob(name)
+        self._call(name, blob.delete)
+
+
+class HTTPStorage(Storage):
+    """Objects in an object store with a plain HTTP interface
+
+    Speaks the protocol of `start_server`: GET (with Range), HEAD, PUT and
+    DELETE on /o/<name>, and GET /list?prefix=<prefix>. Each thread keeps one
+    connection open and reuses it, so the `IO_THREADS` threads of
+    `run_concurrently` don't reconnect for every request.
+
+    Args:
+        base_url (str): e.g. 'http://127.0.0.1:8081'
+        timeout (float, optional): Seconds to wait for the server
+
+    """
+
+    def __init__(self, base_url, timeout=120):
+        self.base_url = base_url.rstrip('/')
+        split = urllib.parse.urlsplit(self.base_url)
+        self._connection_class = (http.client.HTTPSConnection
+                                  if split.scheme == 'https'
+                                  else http.client.HTTPConnection)
+        self._netloc = split.netloc
+        self._path = split.path
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def __repr__(self):
+        return 'HTTPStorage({!r})'.format(self.base_url)
+
+    def _connection(self):
+        # Connections can't be shared across a fork, so each gunicorn worker
+        # opens its own
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = self._connection_class(
+                self._netloc, timeout=self._timeout)
+            local.pid = os.getpid()
+        return local.connection
+
+    def _request(self, method, path, name, body=None, headers=None):
+        url = self.base_url + path
+
+        def attempt():
+            connection = self._connection()
+            try:
+                connection.request(method, self._path + path, body=body,
+                                   headers=headers or {})
+                r = connection.getresponse()
+                data = r.read()
+            except (http.client.HTTPException, OSError):
+                # Open a new connection for the retry
+                connection.close()
+                raise
+            if r.status == 404:
+                raise FileNotFoundError(name)
+            if r.status in (429, 500, 502, 503, 504):
+                raise TransientStorageError(
+                    '{} {} returned {}'.format(method, url, r.status))
+            if r.status >= 400:
+                raise OSError('{} {} returned {}'.format(method, url, r.status))
+            return r, data
+
+        return with_retries(attempt, (TransientStorageError, ConnectionError,
+                                      TimeoutError, http.client.HTTPException))
+
+    @staticmethod
+    def _object_path(name):
+        return '/o/' + urllib.parse.quote(name)
+
+    def read(self, name, start=None, end=None):
+        headers = {}
+        if start is not None or end is not None:
+            headers['Range'] = 'bytes={}-{}'.format(
+                start or 0, '' if end is None else end - 1)
+        return self._request('GET', self._object_path(name), name,
+                             headers=headers)[1]
+
+    def write(self, name, data):
+        self._request('PUT', self._object_path(name), name, body=data)
+
+    def version(self, name):
+        r, _ = self._request('HEAD', self._object_path(name), name)
+        return r.getheader('ETag').strip('"')
+
+    def size(self, name):
+        r, _ = self._request('HEAD', self._object_path(name), name)
+        return int(r.getheader('Content-Length'))
+
+    def list(self, prefix=''):
+        _, data = self._request(
+            'GET', '/list?prefix=' + urllib.parse.quote(prefix), prefix)
+        return json.loads(data)
+
+    def delete(self, name):
+        self._request('DELETE', self._object_path(name), name)
+
+
+def storage_from_url(url):
+    """Make a storage backend from a string, see the module docstring
+
+    Args:
+        url (str): 'local:<directory>', 'gcs:<bucket>', 'http://...' or
+            'memory:'
+
+    Returns:
+        :Storage
+
+    """
+    scheme, _, rest = url.partition(':')
+    if scheme == 'local':
+        return LocalStorage(rest or 'data')
+    if scheme == 'gcs':
+        return GCSStorage(rest or BUCKET)
+    if scheme in ('http', 'https'):
+        return HTTPStorage(url)
+    if scheme == 'memory':
+        return MemoryStorage()
+    raise ValueError('Unknown storage "{}", see module/storage.py'.format(url))
+
+
+def default_storage():
+    """The backend named by `STORAGE_ENV_VAR`, or else the one `LOCAL_DATA` picks"""
+    url = os.environ.get(STORAGE_ENV_VAR)
+    if url:
+        return storage_from_url(url)
+    return LocalStorage() if LOCAL_DATA else GCSStorage()
+
+
+def _parse_range(header, size):
+    """(start, end) from a 'bytes=a-b' Range header, or `None`"""
+    if not header or not header.startswith('bytes='):
+        return None
+    first, _, last = header[len('bytes='):].partition('-')
+    start = int(first) if first else max(0, size - int(last))
+    end = size if not first or not last else min(size, int(last) + 1)
+    return start, end
+
+
+def start_server(storage, host='127.0.0.1', port=0, latency=0):
+    """Serve `storage` over HTTP from a background thread
+
+    The other side of `HTTPStorage`, to run the app or benchmarks against a
+    realistic object store without network access.
+
+    Args:
+        storage (Storage): Where the objects are kept
+        host (str, optional):
+        port (int, optional): 0 picks a free port
+        latency (float, optional): Seconds every request waits before it is
+            answered
+
+    Returns:
+        tuple: (http.server.ThreadingHTTPServer, str) the server, call its
+        `shutdown()` to stop it, and its base URL
+
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections open, so the client's pool is used
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _name(self):
+            path = urllib.parse.urlsplit(self.path).path
+            if not path.startswith('/o/'):
+                return None
+            return urllib.parse.unquote(path[len('/o/'):])
+
+        def _reply(self, status, body=b'', headers=None):
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def _handle(self, func):
+            time.sleep(latency)
+            try:
+                func()
+            except FileNotFoundError:
+                self._reply(404)
+
+        def do_GET(self):
+            split = urllib.parse.urlsplit(self.path)
+            if split.path == '/list':
+                prefix = urllib.parse.parse_qs(split.query).get('prefix', [''])[0]
+                self._handle(lambda: self._reply(
+                    200, json.dumps(storage.list(prefix)).encode(),
+                    {'Content-Type': 'application/json'}))
+            else:
+                self._handle(self._get)
+
+        def _get(self):
+            name = self._name()
+            data = storage.read(name)
+            headers = {'ETag': '"{}"'.format(storage.version(name)),
+                       'Accept-Ranges': 'bytes'}
+            byte_range = _parse_range(self.headers.get('Range'), len(data))
+            if byte_range is None:
+                self._reply(200, data, headers)
+            else:
+                start, end = byte_range
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                    start, end - 1, len(data))
+                self._reply(206, data[start:end], headers)
+
+        def do_HEAD(self):
+            self._handle(self._get)
+
+        def do_PUT(self):
+            length = int(self.headers.get('Content-Length', 0))
+            data = self.rfile.read(length)
+            self._handle(lambda: (storage.write(self._name(), data),
+                                  self._reply(200)))
+
+        def do_DELETE(self):
+            self._handle(lambda: (storage.delete(self._name()),
+                                  self._reply(204)))
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}'.format(*server.server_address[:2])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a directory as an HTTP object store for HTTPStorage')
+    parser.add_argument('--dir', default='data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0)
+    args = parser.parse_args()
+
+    server, url = start_server(LocalStorage(args.dir), args.host, args.port,
+                               args.latency)
+    print('Serving "{}" at {}, use {}={}'.format(
+        args.dir, url, STORAGE_ENV_VAR, url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
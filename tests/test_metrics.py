@@ -0,0 +1,46 @@
+"""Run from the covid-data directory with `python -m pytest tests`"""
+import pytest
+
+dash = pytest.importorskip('dash')
+dcc = pytest.importorskip('dash_core_components')
+html = pytest.importorskip('dash_html_components')
+from dash.dependencies import Input, Output
+
+from module.metrics import add_metrics_endpoint
+
+
+class _FakeFreshData:
+    """Just what /metrics reads from `FreshData`"""
+
+    class figure_cache:
+        @staticmethod
+        def stats():
+            return dict(hits=0, misses=0)
+
+
+def _app():
+    app = dash.Dash(__name__)
+    app.layout = html.Div([dcc.Input(id='state', value='Texas'),
+                           html.Div(id='card')])
+
+    @app.callback(Output('card', 'children'), [Input('state', 'value')])
+    def card(state):
+        return 'Card for {}'.format(state)
+
+    add_metrics_endpoint(app.server, _FakeFreshData())
+    return app
+
+
+def test_callback_is_recorded():
+    client = _app().server.test_client()
+    response = client.post('/_dash-update-component', json=dict(
+        output='card.children',
+        outputs=dict(id='card', property='children'),
+        inputs=[dict(id='state', property='value', value='Texas')],
+        changedPropIds=['state.value']))
+    assert response.status_code == 200
+    assert b'Card for Texas' in response.data
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'dash_callback_seconds_count{callback="card.children",input="Texas"} 1' in text
+    assert 'dash_callback_response_bytes_count{' in text